@@ -3,31 +3,88 @@
 import time
 import random
 import json
-import numpy as np
+import logging
+import heapq
+import threading
 
 import rospy
 from hr_msgs.msg import EmotionState, SetGesture
 from r2_behavior.cfg import AnimationConfig
 from dynamic_reconfigure.server import Server
 
-
-class Utils:
-    def __init__(self):
-        pass
+import instrumentation
+from instrumentation import instrumented
+from wakeup import Wakeup
+
+logger = logging.getLogger('hr.r2_behavior.animation')
+
+EXPRESSION_FIELDS = ['magnitude_min', 'magnitude_max', 'duration_min', 'duration_max']
+GESTURE_FIELDS = ['magnitude_min', 'magnitude_max', 'speed_min', 'speed_max']
+
+class Catalog:
+    """ Expressions or gestures parsed from config, with alias table for constant time weighted selection"""
+
+    def __init__(self, source, fields):
+        self.source = source
+        self.entries = []
+        try:
+            entries = json.loads(source)
+        except ValueError as e:
+            logger.warn("Can't parse animations: {}".format(e))
+            entries = []
+        if not isinstance(entries, list):
+            entries = []
+        for e in entries:
+            try:
+                entry = {'name': e['name'], 'probability': float(e['probability'])}
+                for f in fields:
+                    entry[f] = float(e[f])
+            except (KeyError, TypeError, ValueError) as exc:
+                logger.warn("Invalid animation {}: {}".format(e, exc))
+                continue
+            if entry['probability'] > 0:
+                self.entries.append(entry)
+        self.prob, self.alias = self.alias_table([e['probability'] for e in self.entries])
 
     @staticmethod
-    # Picks random expressions gesture from multidimensional array which has probabilities in first column.
-    # Returns row of array
-    def random(entries):
-        probabilities_sum = sum([e['probability'] for e in entries])
-        probabilities = [e['probability'] / probabilities_sum for e in entries]
-        i = np.random.choice(len(probabilities), p=probabilities)
-        return entries[i]
+    def alias_table(probabilities):
+        # Vose's alias method
+        n = len(probabilities)
+        if n == 0:
+            return [], []
+        total = sum(probabilities)
+        scaled = [p * n / total for p in probabilities]
+        prob = [1.0] * n
+        alias = list(range(n))
+        small = [i for i, p in enumerate(scaled) if p < 1.0]
+        large = [i for i, p in enumerate(scaled) if p >= 1.0]
+        while small and large:
+            s = small.pop()
+            l = large.pop()
+            prob[s] = scaled[s]
+            alias[s] = l
+            scaled[l] += scaled[s] - 1.0
+            if scaled[l] < 1.0:
+                small.append(l)
+            else:
+                large.append(l)
+        return prob, alias
+
+    def random(self):
+        """ Picks random entry based on probabilities, None if catalog is empty"""
+        n = len(self.entries)
+        if n == 0:
+            return None
+        i = int(random.random() * n)
+        if random.random() < self.prob[i]:
+            return self.entries[i]
+        return self.entries[self.alias[i]]
 
 
 class Expressions:
     def __init__(self, config):
         self.config = config
+        self.catalog = Catalog(config['expressions'], EXPRESSION_FIELDS)
         self.next_expression_time = 0
         self.smile = 0
         # Future time
@@ -36,20 +93,19 @@ class Expressions:
     def show_expression(self):
         t = time.time()
 
-        if t > self.next_expression_time:
+        if t >= self.next_expression_time:
             self.smile_started = time.time()*2
             self.next_expression_time = t + random.uniform(self.config['time_between_expressions_min'],
                                                            self.config['time_between_expressions_max'])
-            try:
-                e = Utils.random(json.loads(self.config['expressions']))
-            except Exception as exc:
+            e = self.catalog.random()
+            if e is None:
                 return
             expression = EmotionState()
             expression.name = e['name']
-            expression.magnitude = max(0, min(1, random.uniform(float(e['magnitude_min']), float(e['magnitude_max'])) *
+            expression.magnitude = max(0, min(1, random.uniform(e['magnitude_min'], e['magnitude_max']) *
                                               self.config['expression_magnitude']))
             expression.duration = rospy.Duration(
-                max(1, random.uniform(float(e['duration_min']), float(e['duration_max'])) *
+                max(1, random.uniform(e['duration_min'], e['duration_max']) *
                     self.config['expression_duration']))
             return expression
         return None
@@ -58,22 +114,22 @@ class Expressions:
 class Gestures:
     def __init__(self, config):
         self.config = config
+        self.catalog = Catalog(config['gestures'], GESTURE_FIELDS)
         self.next_gesture_time = 0
 
     def show_gesture(self):
         t = time.time()
-        if t > self.next_gesture_time:
+        if t >= self.next_gesture_time:
             self.next_gesture_time = t + random.uniform(self.config['time_between_gestures_min'],
                                                        self.config['time_between_gestures_max'])
-            try:
-                g = Utils.random(json.loads(self.config['gestures']))
-            except:
+            g = self.catalog.random()
+            if g is None:
                 return
             gesture = SetGesture()
             gesture.name = g['name']
-            gesture.magnitude = max(0, min(3, random.uniform(float(g['magnitude_min']), float(g['magnitude_max'])) *
+            gesture.magnitude = max(0, min(3, random.uniform(g['magnitude_min'], g['magnitude_max']) *
                                            self.config['gesture_magnitude']))
-            gesture.speed = min(3, random.uniform(float(g['speed_min']), float(g['speed_max'])) *
+            gesture.speed = min(3, random.uniform(g['speed_min'], g['speed_max']) *
                                 self.config['gesture_speed'])
             return gesture
         return None
@@ -85,41 +141,75 @@ class Animations:
         self.gestures = None
         self.expressions = None
         self.config = None
-        self.animations = Server(AnimationConfig, self.config_callback, namespace='/current/animations')
+        # Animation channels: name -> (next time, show, publisher). Queue of (time, name) ordered by time
+        self.channels = {}
+        self.queue = []
+        self.lock = threading.Lock()
+        self.wakeup = Wakeup()
         self.expresion_pub = rospy.Publisher('/blender_api/set_emotion_state', EmotionState,queue_size=10)
         self.gesture_pub = rospy.Publisher('/blender_api/set_gesture', SetGesture, queue_size=10)
+        self.animations = Server(AnimationConfig, self.config_callback, namespace='/current/animations')
 
     def config_callback(self, config, level ):
+        with self.lock:
+            self.update_config(config)
+            self.schedule()
+        # Config may enable animations or change timings
+        self.wakeup.set()
+        return config
+
+    def update_config(self, config):
         self.config = config
         if self.init:
             self.gestures = Gestures(config)
             self.expressions = Expressions(config)
+            self.channels = {
+                'expression': (lambda: self.expressions.next_expression_time, self.expressions.show_expression,
+                               self.expresion_pub),
+                'gesture': (lambda: self.gestures.next_gesture_time, self.gestures.show_gesture, self.gesture_pub),
+            }
             self.init = False
         else:
             self.gestures.config = config
             self.expressions.config = config
-
-        return config
-
+            # Catalogs are parsed only if changed
+            if config['gestures'] != self.gestures.catalog.source:
+                self.gestures.catalog = Catalog(config['gestures'], GESTURE_FIELDS)
+            if config['expressions'] != self.expressions.catalog.source:
+                self.expressions.catalog = Catalog(config['expressions'], EXPRESSION_FIELDS)
+
+    def schedule(self):
+        # Rebuilds queue from channels next times
+        self.queue = [(next_time(), name) for name, (next_time, show, pub) in self.channels.items()]
+        heapq.heapify(self.queue)
+
+    @instrumented('animations: timer')
     def timer(self):
-        if self.init:
-            return
-        if not self.config.enable_flag:
-            return
-        # Shows gestures based on timings setr in configs
-        expression = self.expressions.show_expression()
-        gesture = self.gestures.show_gesture()
-        if expression:
-            self.expresion_pub.publish(expression)
-        if gesture:
-            self.gesture_pub.publish(gesture)
+        """ Shows due animations. Returns time (s) until next one, or None if nothing is scheduled"""
+        with self.lock:
+            if self.init or not self.config.enable_flag or not self.queue:
+                return None
+            t = time.time()
+            while self.queue[0][0] <= t:
+                name = heapq.heappop(self.queue)[1]
+                next_time, show, pub = self.channels[name]
+                # Shows gestures based on timings set in configs
+                msg = show()
+                if msg:
+                    pub.publish(msg)
+                heapq.heappush(self.queue, (next_time(), name))
+            return self.queue[0][0] - t
+
+    def run(self):
+        # Sleeps until next animation is due or config is changed
+        rospy.on_shutdown(self.wakeup.set)
+        while not rospy.is_shutdown():
+            self.wakeup.wait(self.timer())
 
 if __name__ == "__main__":
     rospy.init_node("animations")
-    rate = rospy.Rate(10)
+    instrumentation.start()
     animations = Animations()
-    while not rospy.is_shutdown():
-        animations.timer()
-        rate.sleep()
+    animations.run()
 
 
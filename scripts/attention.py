@@ -1,11 +1,13 @@
 #!/usr/bin/env python
 import rospy
 import time
+import copy
 import threading
 import operator
 import random
 import logging
 import math
+import numpy as np
 # Attention regions
 from dynamic_reconfigure.server import Server
 from geometry_msgs.msg import Point
@@ -17,9 +19,14 @@ from hr_msgs.msg import pau
 from performances.nodes import attention as AttentionRegion
 from r2_behavior.cfg import AttentionConfig
 from std_msgs.msg import String, Float64, UInt8, Int64
+from diagnostic_msgs.msg import DiagnosticArray, DiagnosticStatus, KeyValue
 import dynamic_reconfigure.client
 import tf
 
+import instrumentation
+from instrumentation import Histogram, instrumented
+from clock import monotonic
+
 logger = logging.getLogger('hr.r2_behavior.attention')
 
 # in interactive settings with people, the EyeContact machine is used to define specific states for eye contact
@@ -52,15 +59,15 @@ class LookAt:
 
 # the mirroring machine is the lowest level and has the robot mirror the face it is currently looking at
 # this is purely mechanical, so it follows a very strict control logic; the overall state machine controls which mirroring more is actually used by switching the mirroring state
-# class Mirroring:
-#     IDLE = 0  # no mirroring
-#     EYEBROWS = 1  # mirror the eyebrows only
-#     EYELIDS = 2  # mirror the blinking only
-#     EYES = 3  # mirror eyebrows and eyelids
-#     MOUTH = 4  # mirror mouth opening
-#     MOUTH_EYEBROWS = 5  # mirror mouth and eyebrows
-#     MOUTH_EYELIDS = 6  # mirror mouth and eyelids
-#     ALL = 7  # mirror everything
+class Mirroring:
+    IDLE = 0  # no mirroring
+    EYEBROWS = 1  # mirror the eyebrows only
+    EYELIDS = 2  # mirror the blinking only
+    EYES = 3  # mirror eyebrows and eyelids
+    MOUTH = 4  # mirror mouth opening
+    MOUTH_EYEBROWS = 5  # mirror mouth and eyebrows
+    MOUTH_EYELIDS = 6  # mirror mouth and eyelids
+    ALL = 7  # mirror everything
 
 
 # params: eyebrows magnitude, eyelid magnitude, mouth magnitude
@@ -83,6 +90,603 @@ REGIONS = {
     2: 'specific'   # Co-presenter or some other region for specific setting
 }
 
+class RegionCache:
+    """ Attention regions grouped by type. Params are read from rospy cache, which is updated by master
+    when they change, so refresh only calls param server first time"""
+
+    def __init__(self, robot_name):
+        # Performance regions override general ones
+        self.params = ['/{}/performance_regions'.format(robot_name), '/{}/regions'.format(robot_name)]
+        self.regions = {}
+        self._by_type = {}
+
+    def refresh(self):
+        regions = {}
+        for param in self.params:
+            try:
+                regions = rospy.get_param_cached(param)
+            except KeyError:
+                regions = {}
+            except Exception as e:
+                logger.warn("Can't refresh attention regions: {}".format(e))
+                return
+            if len(regions) > 0:
+                break
+        if regions == self.regions:
+            return
+        # Param cache updates nested values in place, so own copy is kept for comparison
+        regions = copy.deepcopy(regions)
+        # Regions grouped by type, so sampling only needs to look at regions of requested type
+        by_type = {}
+        for name, r in regions.items():
+            if isinstance(r, dict) and 'regiontype' in r:
+                by_type.setdefault(r['regiontype'], {})[name] = r
+        self._by_type = by_type
+        self.regions = regions
+
+    def get_point(self, region):
+        self.refresh()
+        region_type = REGIONS[region]
+        point = AttentionRegion.get_point_from_regions(self._by_type.get(region_type, self.regions), region_type)
+        return Point(x=point['x'], y=point['y'], z=point['z'])
+
+
+# Time (s) last known transform can be used if tf is not available for requested time
+TF_MAX_AGE = 0.5
+
+
+class TransformCache:
+    """ Transforms to target frame as 4x4 matrices, tf is looked up at most once per stamp"""
+
+    def __init__(self, listener, target='blender'):
+        self.listener = listener
+        self.target = target
+        # frame_id: (stamp, matrix)
+        self.transforms = {}
+
+    def get(self, frame_id, ts):
+        cached = self.transforms.get(frame_id)
+        if cached is not None and cached[0] == ts:
+            return cached[1]
+        if self.listener.canTransform(self.target, frame_id, ts):
+            trans, rot = self.listener.lookupTransform(self.target, frame_id, ts)
+            m = tf.transformations.quaternion_matrix(rot)
+            m[:3, 3] = trans
+            self.transforms[frame_id] = (ts, m)
+            return m
+        # Reuse last transform until it gets stale
+        if cached is not None and abs((ts - cached[0]).to_sec()) < TF_MAX_AGE:
+            return cached[1]
+        raise Exception("tf from {} to {} did not work".format(frame_id, self.target))
+
+    def prefetch(self, frame_id, ts):
+        """ Looks up transform in advance, so it is available later without calling tf"""
+        try:
+            self.get(frame_id, ts)
+        except Exception:
+            pass
+
+    def transform(self, points, frame_id, ts):
+        """ Transforms Nx3 array of points with single matrix multiply"""
+        m = self.get(frame_id, ts)
+        return np.dot(points, m[:3, :3].T) + m[:3, 3]
+
+
+# How often (s) synthesizer timings and lock hold times are reported
+DIAGNOSTICS_TIME = 5.0
+# Longest time (s) counted for a single tick, so long stalls do not skip several switches at once
+MAX_TICK_TIME = 0.5
+# Histogram bins for tick timings (ms)
+TICK_BINS = [1, 2, 5, 10, 20, 50, 100]
+
+
+class TimedLock:
+    """ Lock which keeps statistics how long it is being held"""
+
+    def __init__(self, name):
+        self.name = name
+        self._lock = threading.Lock()
+        self._acquired = 0
+        self.reset()
+
+    def reset(self):
+        self.count = 0
+        self.total = 0.0
+        self.max = 0.0
+
+    def __enter__(self):
+        self._lock.acquire()
+        self._acquired = time.time()
+        return self
+
+    def __exit__(self, *args):
+        held = time.time() - self._acquired
+        self.count += 1
+        self.total += held
+        self.max = max(self.max, held)
+        self._lock.release()
+
+    def report(self):
+        """ Returns hold time statistics since last report"""
+        with self._lock:
+            mean = 1000.0 * self.total / self.count if self.count > 0 else 0.0
+            values = [
+                KeyValue('{} lock count'.format(self.name), str(self.count)),
+                KeyValue('{} lock mean (ms)'.format(self.name), '{:.2f}'.format(mean)),
+                KeyValue('{} lock max (ms)'.format(self.name), '{:.2f}'.format(1000.0 * self.max)),
+            ]
+            self.reset()
+        return values
+
+
+class TickStats:
+    """ Synthesizer tick latency and lateness, a tick overruns if it finishes after next one is due"""
+
+    def __init__(self, name, rate):
+        self.name = name
+        self.period = 1.0 / rate
+        self.latency = Histogram('latency (ms)', TICK_BINS)
+        self.lateness = Histogram('lateness (ms)', TICK_BINS)
+        self.ticks = 0
+        self.overruns = 0
+
+    def add(self, latency, lateness):
+        self.ticks += 1
+        self.latency.add(1000.0 * latency)
+        self.lateness.add(1000.0 * lateness)
+        if latency + lateness > self.period:
+            self.overruns += 1
+
+    def status(self):
+        status = DiagnosticStatus()
+        status.name = self.name
+        status.hardware_id = 'behavior'
+        if self.overruns > 0:
+            status.level = DiagnosticStatus.WARN
+            status.message = '{} of {} ticks overrun'.format(self.overruns, self.ticks)
+        else:
+            status.level = DiagnosticStatus.OK
+            status.message = '{} ticks'.format(self.ticks)
+        status.values = [KeyValue('ticks', str(self.ticks)), KeyValue('overruns', str(self.overruns))] + \
+            self.latency.report() + self.lateness.report()
+        self.ticks = 0
+        self.overruns = 0
+        return status
+
+
+def positions_array(items):
+    """ Nx3 array of items positions"""
+    return np.array([(i.position.x, i.position.y, i.position.z) for i in items], dtype=np.float64).reshape(-1, 3)
+
+
+class Observations:
+    """ Perception state converted once per message into arrays used by selection policies.
+    Snapshots are not modified after creation, so they can be swapped in without locking."""
+
+    def __init__(self, state=None):
+        self.state = state if state is not None else State()
+        # arrival time, and ROS time at arrival to convert capture stamps
+        self.time = monotonic()
+        self.ros_time = rospy.get_time()
+        faces = self.state.faces
+        self.face_positions = positions_array(faces)
+        self.face_ids = np.array([f.id for f in faces], dtype=np.int64)
+        self.face_confidences = np.array([f.confidence for f in faces], dtype=np.float64)
+        # face id: index in faces list
+        self.faces_by_id = dict((f.id, i) for i, f in enumerate(faces))
+        self.face_mouths = np.array([f.mouth_open for f in faces], dtype=np.float64)
+        self.face_recognized = np.array([bool(f.first_name) for f in faces], dtype=np.float64)
+        self.pose_positions = positions_array(self.state.poses)
+        self.saliency_positions = positions_array(self.state.salientpoints)
+        # most salient points of this message, strongest first
+        scores = np.array([p.confidence for p in self.state.salientpoints], dtype=np.float64)
+        scores[~np.isfinite(self.saliency_positions).all(axis=1)] = -np.inf
+        top = np.argsort(-scores, kind='mergesort')[:SALIENCY_TOP]
+        top = top[np.isfinite(scores[top])]
+        self.saliency_top = top
+        self.saliency_scores = scores[top]
+
+    def capture_time(self, stamp):
+        """ Capture stamp converted to monotonic clock, arrival time if stamp is not set"""
+        if stamp.is_zero():
+            return self.time
+        return self.time - max(0.0, self.ros_time - stamp.to_sec())
+
+    def face(self, id):
+        """ Face with given id or None if it is not visible"""
+        i = self.faces_by_id.get(id)
+        return None if i is None else self.state.faces[i]
+
+    @staticmethod
+    def nearest(positions, point=None):
+        """ Index of position nearest to point, or to the robot (horizontal distance) if no point given.
+        Positions which are not finite are never nearest, -1 if there is no other"""
+        if len(positions) == 0:
+            return -1
+        if point is None:
+            d = np.einsum('ij,ij->i', positions[:, :2], positions[:, :2])
+        else:
+            diff = positions - point
+            d = np.einsum('ij,ij->i', diff, diff)
+        d[~np.isfinite(positions).all(axis=1)] = np.inf
+        i = int(np.argmin(d))
+        return i if np.isfinite(d[i]) else -1
+
+
+# Salient points taken from each perception message, and most points kept in memory
+SALIENCY_TOP = 10
+SALIENCY_MAX_POINTS = 100
+# Salient target follows moving point within radius (m)
+SALIENCY_TRACK_RADIUS = 0.2
+# Selection is postponed to next tick if tick has already taken longer (s)
+SALIENCY_TICK_BUDGET = 0.005
+
+
+class SaliencyMemory:
+    """ Most salient points of recent perception messages, each kept for keep_time. Size is bounded, so is
+    the cost of selection"""
+
+    def __init__(self):
+        self.positions = np.zeros((0, 3))
+        self.scores = np.zeros(0)
+        self.times = np.zeros(0)
+
+    def add(self, observations, keep_time):
+        keep = self.times > observations.time - keep_time
+        top = observations.saliency_top
+        self.positions = np.concatenate([self.positions[keep], observations.saliency_positions[top]])[
+                         -SALIENCY_MAX_POINTS:]
+        self.scores = np.concatenate([self.scores[keep], observations.saliency_scores])[-SALIENCY_MAX_POINTS:]
+        self.times = np.concatenate([self.times[keep], np.full(len(top), observations.time)])[
+                     -SALIENCY_MAX_POINTS:]
+
+    def select(self, t, keep_time, previous=None):
+        """ Position of strongest and most recent point, other than previous one. None if there are no points"""
+        age = t - self.times
+        weights = self.scores * (1.0 - age / keep_time)
+        weights[age > keep_time] = -np.inf
+        if previous is not None:
+            diff = self.positions - previous
+            weights[np.einsum('ij,ij->i', diff, diff) < SALIENCY_TRACK_RADIUS ** 2] = -np.inf
+        if len(weights) == 0 or not np.isfinite(weights).any():
+            return None
+        return self.positions[np.argmax(weights)]
+
+
+# Angular occupancy grid used to avoid looking at anything: bin size, and azimuth and elevation range (rad)
+AVOID_BIN = math.radians(10)
+AVOID_AZIMUTH = math.radians(60)
+AVOID_ELEVATION = math.radians(30)
+# Cost added to directions away from straight ahead, so nearer free directions are preferred
+AVOID_CENTER_WEIGHT = 0.1
+# Direction with higher occupancy is no longer considered free
+AVOID_OCCUPIED = 0.5
+
+
+class OccupancyGrid:
+    """ Counts faces, poses and salient points in azimuth/elevation bins of blender frame, decaying with keep_time.
+    Emptiest direction is found once per perception message, so looking it up on tick is constant time"""
+
+    def __init__(self):
+        self.az_bins = int(round(2 * AVOID_AZIMUTH / AVOID_BIN))
+        self.el_bins = int(round(2 * AVOID_ELEVATION / AVOID_BIN))
+        az = (np.arange(self.az_bins) + 0.5) * AVOID_BIN - AVOID_AZIMUTH
+        el = (np.arange(self.el_bins) + 0.5) * AVOID_BIN - AVOID_ELEVATION
+        el, az = np.meshgrid(el, az, indexing='ij')
+        # unit vector of each bin center, and its distance from straight ahead
+        self.directions = np.stack([np.cos(el) * np.cos(az), np.cos(el) * np.sin(az), np.sin(el)],
+                                   axis=-1).reshape(-1, 3)
+        self.center_cost = AVOID_CENTER_WEIGHT * ((az / AVOID_AZIMUTH) ** 2 + (el / AVOID_ELEVATION) ** 2)
+        self.occupancy = np.zeros((self.el_bins, self.az_bins))
+        self.cost = np.zeros(self.el_bins * self.az_bins)
+        self.best = int(np.argmin(self.center_cost))
+        self.time = None
+
+    def update(self, points, t, keep_time):
+        """ Adds Nx3 points in blender frame seen at time t"""
+        if self.time is not None:
+            self.occupancy *= math.exp(-max(0.0, t - self.time) / keep_time)
+        self.time = t
+        points = points[np.isfinite(points).all(axis=1)]
+        az = np.arctan2(points[:, 1], points[:, 0])
+        el = np.arctan2(points[:, 2], np.hypot(points[:, 0], points[:, 1]))
+        i = np.floor((az + AVOID_AZIMUTH) / AVOID_BIN).astype(np.int64)
+        j = np.floor((el + AVOID_ELEVATION) / AVOID_BIN).astype(np.int64)
+        inside = (i >= 0) & (i < self.az_bins) & (j >= 0) & (j < self.el_bins)
+        self.occupancy += np.bincount(j[inside] * self.az_bins + i[inside],
+                                      minlength=self.el_bins * self.az_bins).reshape(self.el_bins, self.az_bins)
+        # directions next to occupied ones are not free either
+        padded = np.pad(self.occupancy, 1, mode='edge')
+        blurred = sum(padded[dj:dj + self.el_bins, di:di + self.az_bins] for dj in range(3) for di in range(3)) / 9.0
+        self.cost = blurred.reshape(-1)
+        self.best = int(np.argmin(blurred + self.center_cost))
+
+    def occupied(self, k):
+        return self.cost[k] > AVOID_OCCUPIED
+
+
+# Face features mirrored, and shapekeys they drive: (shapekey, group, coefficients of features and constant)
+MIRRORING_FEATURES = ['left_brow', 'right_brow', 'left_eyelid', 'right_eyelid', 'mouth_open']
+MIRRORING_SHAPEKEYS = [
+    ('brow_outer_UP.L', 'eyebrows', [1.0, 0, 0, 0, 0, 0]),
+    ('brow_inner_UP.L', 'eyebrows', [0.8, 0, 0, 0, 0, 0]),
+    ('brow_outer_DN.L', 'eyebrows', [-1.0, 0, 0, 0, 0, 1.0]),
+    ('brow_outer_UP.R', 'eyebrows', [0, 1.0, 0, 0, 0, 0]),
+    ('brow_inner_UP.R', 'eyebrows', [0, 0.8, 0, 0, 0, 0]),
+    ('brow_outer_DN.R', 'eyebrows', [0, -1.0, 0, 0, 0, 1.0]),
+    # eyes closed is average of both eyelids closed
+    ('eye-blink.UP.R', 'eyelids', [0, 0, -0.5, -0.5, 0, 1.0]),
+    ('eye-blink.UP.L', 'eyelids', [0, 0, -0.5, -0.5, 0, 1.0]),
+    ('eye-blink.LO.R', 'eyelids', [0, 0, -0.5, -0.5, 0, 1.0]),
+    ('eye-blink.LO.L', 'eyelids', [0, 0, -0.5, -0.5, 0, 1.0]),
+    ('lip-JAW.DN', 'mouth', [0, 0, 0, 0, 1.0, 0]),
+]
+MIRRORING_GROUPS = {
+    Mirroring.EYEBROWS: ['eyebrows'],
+    Mirroring.EYELIDS: ['eyelids'],
+    Mirroring.EYES: ['eyebrows', 'eyelids'],
+    Mirroring.MOUTH: ['mouth'],
+    Mirroring.MOUTH_EYEBROWS: ['mouth', 'eyebrows'],
+    Mirroring.MOUTH_EYELIDS: ['mouth', 'eyelids'],
+    Mirroring.ALL: ['eyebrows', 'eyelids', 'mouth'],
+}
+# Smoothing time constant (s), highest publish rate (Hz), and smallest shapekey change published
+MIRRORING_SMOOTH_TIME = 0.1
+MIRRORING_MAX_RATE = 15
+MIRRORING_THRESHOLD = 0.02
+
+
+class MirroringStage:
+    """ Maps features of the face looked at to shapekeys with coefficient table of current mode. Output is smoothed
+    every tick, and published at most at MIRRORING_MAX_RATE only if any shapekey moved more than
+    MIRRORING_THRESHOLD. Arrays and pau message are allocated only when mode changes"""
+
+    def __init__(self):
+        self.set_mode(Mirroring.IDLE)
+
+    def set_mode(self, mode):
+        groups = MIRRORING_GROUPS.get(mode, [])
+        rows = [r for r in MIRRORING_SHAPEKEYS if r[1] in groups]
+        self.coeffs = np.array([r[2] for r in rows], dtype=np.float64).reshape(-1, len(MIRRORING_FEATURES) + 1)
+        self.msg = pau()
+        self.msg.m_shapekeys = [r[0] for r in rows]
+        self.msg.m_coeffs = [0.0] * len(rows)
+        # features with constant term, and their smoothed values
+        self.features = np.ones(len(MIRRORING_FEATURES) + 1)
+        self.smoothed = np.zeros(len(MIRRORING_FEATURES) + 1)
+        self.delta = np.zeros(len(MIRRORING_FEATURES) + 1)
+        self.values = np.zeros(len(rows))
+        self.published = np.zeros(len(rows))
+        self.changes = np.zeros(len(rows))
+        self.started = False
+        self.publish_time = None
+
+    def step(self, face, t, dt):
+        """ Returns pau message to publish, or None"""
+        if len(self.values) == 0:
+            return None
+        for i, name in enumerate(MIRRORING_FEATURES):
+            self.features[i] = getattr(face, name)
+        # Holds last output while perception has no estimate, NaN would stay in smoothed values for good
+        if not np.isfinite(self.features).all():
+            return None
+        if self.started:
+            np.subtract(self.features, self.smoothed, out=self.delta)
+            self.delta *= 1.0 - math.exp(-dt / MIRRORING_SMOOTH_TIME)
+            self.smoothed += self.delta
+        else:
+            self.smoothed[:] = self.features
+            self.started = True
+        np.dot(self.coeffs, self.smoothed, out=self.values)
+        np.clip(self.values, 0.0, 1.0, out=self.values)
+        if self.publish_time is not None:
+            if t - self.publish_time < 1.0 / MIRRORING_MAX_RATE:
+                return None
+            np.subtract(self.values, self.published, out=self.changes)
+            if np.abs(self.changes, out=self.changes).max() < MIRRORING_THRESHOLD:
+                return None
+        self.published[:] = self.values
+        self.publish_time = t
+        self.msg.m_coeffs[:] = self.values
+        return self.msg
+
+
+# Faces not seen for longer (s) are forgotten by scorer
+FACE_HISTORY_TIME = 60.0
+# Time (s) after which face not looked at gets full novelty score
+NOVELTY_TIME = 10.0
+# Time constant (s) of speaking activity, and mouth movement (mouth_open units/s) counted as speaking
+SPEAKING_TIME = 0.5
+SPEAKING_ACTIVITY = 1.0
+# Score by which other face must beat current one to switch before faces timer expires
+SCORE_SWITCH_MARGIN = 0.5
+
+
+class SalienceScorer:
+    """ Scores all faces of an observation in one vectorized pass. History of each face (when it was last looked
+    at, mouth movement) is kept in arrays sorted by face id, and aligned with observations once per message.
+    Terms are functions returning score array in range 0..1, each weighted by score_<term> config value"""
+
+    def __init__(self):
+        self.observations = Observations()
+        self.ids = np.zeros(0, dtype=np.int64)
+        self.seen = np.zeros(0)
+        self.last_look = np.zeros(0)
+        self.mouth = np.zeros(0)
+        self.activity = np.zeros(0)
+        # history index of each face in observations
+        self.index = np.zeros(0, dtype=np.int64)
+        self.terms = {
+            'distance': self.distance_term,
+            'novelty': self.novelty_term,
+            'speaking': self.speaking_term,
+            'recognized': self.recognized_term,
+        }
+
+    def update(self, observations):
+        now = observations.time
+        ids = observations.face_ids
+        # forget old faces and add new ones, keeping arrays sorted by id
+        keep = self.seen > now - FACE_HISTORY_TIME
+        new = np.setdiff1d(ids, self.ids[keep])
+        ids_all = np.concatenate([self.ids[keep], new])
+        order = np.argsort(ids_all, kind='mergesort')
+        extend = lambda a, v: np.concatenate([a[keep], np.full(len(new), v)])[order]
+        self.ids = ids_all[order]
+        self.last_look = extend(self.last_look, -np.inf)
+        self.activity = extend(self.activity, 0.0)
+        seen = extend(self.seen, now)
+        mouth = extend(self.mouth, np.nan)
+        index = np.searchsorted(self.ids, ids)
+        # speaking activity is decaying average of mouth movement speed
+        dt = np.maximum(now - seen[index], 1e-3)
+        change = np.abs(observations.face_mouths - mouth[index]) / dt
+        change[np.isnan(change)] = 0.0
+        decay = np.exp(-dt / SPEAKING_TIME)
+        self.activity[index] = decay * self.activity[index] + (1.0 - decay) * change
+        mouth[index] = observations.face_mouths
+        seen[index] = now
+        self.seen = seen
+        self.mouth = mouth
+        self.index = index
+        self.observations = observations
+
+    def looked_at(self, id, t):
+        i = np.searchsorted(self.ids, id)
+        if i < len(self.ids) and self.ids[i] == id:
+            self.last_look[i] = t
+
+    def distance_term(self, t):
+        xy = self.observations.face_positions[:, :2]
+        return 1.0 / (1.0 + np.sqrt(np.einsum('ij,ij->i', xy, xy)))
+
+    def novelty_term(self, t):
+        return np.minimum(t - self.last_look[self.index], NOVELTY_TIME) / NOVELTY_TIME
+
+    def speaking_term(self, t):
+        return np.minimum(self.activity[self.index] / SPEAKING_ACTIVITY, 1.0)
+
+    def recognized_term(self, t):
+        return self.observations.face_recognized
+
+    def scores(self, t, config):
+        scores = np.zeros(len(self.index))
+        for name, term in self.terms.items():
+            weight = config['score_{}'.format(name)]
+            if weight > 0:
+                scores += weight * term(t)
+        scores *= self.observations.face_confidences
+        # faces without valid position are never selected
+        scores[~np.isfinite(scores)] = -np.inf
+        return scores
+
+
+# Target filter gains for position and velocity, and how far ahead (s) target position can be predicted
+TARGET_FILTER_ALPHA = 0.5
+TARGET_FILTER_BETA = 0.1
+MAX_PREDICTION_TIME = 0.5
+# Velocity is not updated from observations closer in time (s), their difference is mostly noise
+TARGET_FILTER_MIN_DT = 0.01
+# Targets closer (m) to previously published target are not published
+TARGET_THRESHOLD = 0.01
+
+
+class OutputStage:
+    """ Messages queued by synthesizer, published after the tick. Target updates for the same topic are merged,
+    targets which barely moved are dropped, and each target topic is limited to max_rate"""
+
+    def __init__(self, max_rate):
+        self.min_interval = 1.0 / max_rate
+        self.outbox = []
+        # publisher: latest target not yet published
+        self.pending = {}
+        # publisher: (time, target) last published
+        self.published = {}
+        self.counts = {}
+
+    def count(self, pub, key):
+        counts = self.counts.setdefault(pub.resolved_name, {'published': 0, 'merged': 0, 'dropped': 0, 'delayed': 0})
+        counts[key] += 1
+
+    def add(self, pub, msg):
+        self.outbox.append((pub, msg))
+
+    def add_target(self, pub, msg):
+        if pub in self.pending:
+            self.count(pub, 'merged')
+        self.pending[pub] = msg
+
+    def discard_targets(self):
+        """ Drops targets still held back by rate limit, so they are not published after head should stop"""
+        self.pending.clear()
+
+    def flush(self, now):
+        outbox, self.outbox = self.outbox, []
+        for pub, msg in outbox:
+            pub.publish(msg)
+            self.count(pub, 'published')
+        for pub, msg in list(self.pending.items()):
+            last_time, last = self.published.get(pub, (None, None))
+            if last is not None and last.speed == msg.speed and \
+                    (last.x - msg.x) ** 2 + (last.y - msg.y) ** 2 + (last.z - msg.z) ** 2 < TARGET_THRESHOLD ** 2:
+                # Blender doesn't need to follow detection noise
+                del self.pending[pub]
+                self.count(pub, 'dropped')
+            elif last_time is not None and now - last_time < self.min_interval:
+                # Kept until allowed
+                self.count(pub, 'delayed')
+            else:
+                del self.pending[pub]
+                self.published[pub] = (now, msg)
+                pub.publish(msg)
+                self.count(pub, 'published')
+
+    def report(self):
+        values = []
+        for topic, counts in sorted(self.counts.items()):
+            values += [KeyValue('{} {}'.format(topic, k), str(v)) for k, v in sorted(counts.items())]
+        self.counts = {}
+        return values
+
+
+class TargetFilter:
+    """ Constant velocity (alpha-beta) filter of target position. Smooths noisy detections and
+    predicts where target is at tick time, from observations which may be older"""
+
+    def __init__(self, alpha=TARGET_FILTER_ALPHA, beta=TARGET_FILTER_BETA):
+        self.alpha = alpha
+        self.beta = beta
+        self.reset()
+
+    def reset(self, id=None):
+        self.id = id
+        self.pos = None
+        self.vel = np.zeros(3)
+        self.t = None
+
+    def update(self, pos, t):
+        if np.isnan(pos).any():
+            return
+        if self.pos is None:
+            self.pos = pos
+            self.t = t
+            return
+        dt = t - self.t
+        if dt <= 0:
+            return
+        predicted = self.pos + self.vel * dt
+        residual = pos - predicted
+        self.pos = predicted + self.alpha * residual
+        if dt >= TARGET_FILTER_MIN_DT:
+            self.vel = self.vel + (self.beta / dt) * residual
+        self.t = t
+
+    def predict(self, t):
+        if self.pos is None:
+            return None
+        return self.pos + self.vel * max(0.0, min(t - self.t, MAX_PREDICTION_TIME))
+
+
 # awareness: saliency, hands, faces, motion sensors
 
 class Attention:
@@ -90,12 +694,9 @@ class Attention:
 
     def InitCounter(self, counter, minmax):
         try:
-            min_v = min(int(getattr(self, "{}_min".format(minmax))), int(getattr(self, "{}_max".format(minmax))))
-            max_v = max(int(getattr(self, "{}_min".format(minmax))), int(getattr(self, "{}_max".format(minmax))))
-            val = random.randint(int(min_v * self.synthesizer_rate),
-                                 int(max_v * self.synthesizer_rate))
+            val = random.uniform(getattr(self, "{}_min".format(minmax)), getattr(self, "{}_max".format(minmax)))
         except:
-            val = 1
+            val = 0
         setattr(self, "{}_counter".format(counter), val)
 
     def __getattr__(self, item):
@@ -107,32 +708,51 @@ class Attention:
     def __init__(self):
 
         # create lock
-        self.lock = threading.Lock()
+        self.lock = TimedLock('attention')
+        # Messages published by synthesizer are sent after lock is released
+        self.output = OutputStage(rospy.get_param('~max_target_rate', 15))
 
         self.robot_name = rospy.get_param("/robot_name")
         self.eyecontact = 0
         self.lookat = 0
         self.mirroring = 0
+        self.mirror = MirroringStage()  # maps current face features to shapekeys
         # By default look with head and eyes
         self.gaze = 2
         # setup face, hand and saliency structures
         self.state = State()
-        self.current_face_index = -1  # index to current face
+        self.observations = Observations(self.state)
+        # latest perception snapshot, replaced by perception callback and picked up by the synthesizer
+        self.latest_observations = self.observations
+        self.current_face_id = None  # ID of current face, tracked regardless of its index in the faces list
         self.wanted_face_id = 0  # ID for wanted face
-        self.current_saliency_index = -1  # index of current saliency vector
+        self.saliency = SaliencyMemory()  # recent salient points
+        self.saliency_target = None  # position of current salient point
+        self.avoid = OccupancyGrid()  # directions of recently seen things
+        self.avoid_observations = None  # last observations added to occupancy grid
+        self.avoid_target = None  # occupancy grid bin currently looked at
+        self.avoid_counter = 0
         self.current_eye = 0  # current eye (0 = left, 1 = right, 2 = mouth)
         self.interrupted_state = LookAt.IDLE  # which state was interrupted to look at all faces
         self.interrupting = False  # LookAt state is currently interrupted to look at all faces
 
         self.gaze_delay_counter = 0  # delay counter after with gaze or head follows head or gaze
         self.gaze_pos = None  # current gaze position
+        self.face_filter = TargetFilter()  # filter for position of current face
+        self.scorer = SalienceScorer()  # scores faces to select next one
+        self.last_switch = -float('inf')  # time of last face switch
         # counter to run if face not visible
         self.no_face_counter = 0
         self.no_switch_counter = 0
         self.last_pose_counter = 0
         self.last_pose = None
+        # observations last_pose was selected from
+        self.last_pose_observations = None
         self.eyecontact_state = EyeContact.TRIANGLE
         self.tf_listener = tf.TransformListener(False, rospy.Duration.from_sec(1))
+        self.transforms = TransformCache(self.tf_listener)
+        # Attention regions
+        self.regions = RegionCache(self.robot_name)
 
         # tracks last face by fsdk_id, if changes informs eye tracking to pause
         self.last_target = -2
@@ -147,7 +767,14 @@ class Attention:
         # Topic to publish target changes
         self.current_target_pub = rospy.Publisher('/behavior/current_target', Int64, queue_size=5, latch=True)
 
-        self.synthesizer_rate = 30
+        # Timings are independent of the rate, it can be lowered on slower machines
+        self.synthesizer_rate = rospy.get_param('~synthesizer_rate', 30)
+        # Seconds elapsed since previous tick, all counters are in seconds
+        self.tick_time = 1.0 / self.synthesizer_rate
+        self.last_tick = None
+        self.tick_stats = TickStats('attention: synthesizer', self.synthesizer_rate)
+        self.diagnostics_time = monotonic()
+        self.diagnostics_pub = rospy.Publisher('/behavior/diagnostics', DiagnosticArray, queue_size=1)
 
         self.hand_events_pub = rospy.Publisher('/hand_events', String, queue_size=1)
 
@@ -172,7 +799,19 @@ class Attention:
             id = int(time.time()*10)
         if id <> self.last_target:
             self.last_target = id
-            self.current_target_pub.publish(id)
+            self.Publish(self.current_target_pub, Int64(id))
+
+
+    def Publish(self, pub, msg):
+        self.output.add(pub, msg)
+
+
+    def PublishTarget(self, pub, msg):
+        self.output.add_target(pub, msg)
+
+
+    def FlushOutbox(self):
+        self.output.flush(monotonic())
 
 
     def UpdateStateDisplay(self):
@@ -190,12 +829,12 @@ class Attention:
             # and set the states for each state machine
             #self.SetEyeContact(config.eyecontact_state)
             self.SetLookAt(config.lookat_state)
-            # self.SetMirroring(config.mirroring_state)
+            self.SetMirroring(config.mirroring_state)
             # self.SetGaze(config.gaze_state)
             # Counters
             if not self.configs_init:
                 self.timer = rospy.Timer(rospy.Duration.from_sec(1.0 / self.synthesizer_rate), self.HandleTimer)
-                # self.InitCounter("saliency","saliency_time")
+                self.InitCounter("saliency","saliency_time")
                 self.InitCounter("faces", "faces_time")
                 self.InitCounter("region", "region_time")
                 # self.InitCounter("rest", "rest_time")
@@ -208,18 +847,8 @@ class Attention:
         if frame_id == 'blender':
             return pos
         else:
-            ps = PointStamped()
-            ps.header.seq = 0
-            ps.header.stamp = ts
-            ps.header.frame_id = frame_id
-            ps.point.x = pos.x
-            ps.point.y = pos.y
-            ps.point.z = pos.z
-            if self.tf_listener.canTransform("blender", frame_id, ts):
-                pst = self.tf_listener.transformPoint("blender", ps)
-                return pst.point
-            else:
-                raise Exception("tf from robot to blender did not work")
+            p = self.transforms.transform(np.array([pos.x, pos.y, pos.z]), frame_id, ts)
+            return Point(x=p[0], y=p[1], z=p[2])
 
 
     def SetGazeFocus(self, pos, speed, ts, frame_id='robot'):
@@ -231,7 +860,7 @@ class Attention:
             msg.z = pos.z if not math.isnan(pos.z) else 0
             msg.z = max(-0.3, min(0.3, msg.z))
             msg.speed = speed
-            self.gaze_focus_pub.publish(msg)
+            self.PublishTarget(self.gaze_focus_pub, msg)
         except Exception as e:
             logger.warn("Gaze focus exception: {}".format(e))
 
@@ -244,7 +873,7 @@ class Attention:
             msg.z = pos.z if not math.isnan(pos.z) else 0
             msg.z = max(-0.3, min(0.3, msg.z))
             msg.speed = speed
-            self.head_focus_pub.publish(msg)
+            self.PublishTarget(self.head_focus_pub, msg)
         except Exception as e:
             logger.warn("Head focus exception: {}".format(e))
 
@@ -252,6 +881,13 @@ class Attention:
     def UpdateGaze(self, pos, ts, frame_id="robot"):
 
         self.gaze_pos = pos
+        # Transform once for both gaze and head
+        try:
+            pos = self.getBlenderPos(pos, ts, frame_id)
+            frame_id = 'blender'
+        except Exception as e:
+            logger.warn("Gaze update exception: {}".format(e))
+            return
 
         if self.gaze == Gaze.GAZE_ONLY:
             self.SetGazeFocus(pos, 5.0, ts, frame_id)
@@ -274,20 +910,33 @@ class Attention:
         # switch to the next (or first) face
         if self.state is None or len(self.state.faces) == 0:
             # there are no faces, so select none
-            self.current_face_index = -1
+            self.current_face_id = None
             return
 
         if self.lookat  == LookAt.NEAREST_FACE:
-            self.current_face_index, f = min(enumerate(self.state.faces),
-                                             key=lambda f: (f[1].position.x**2+f[1].position.y**2))
+            index = Observations.nearest(self.observations.face_positions)
         else:
-            # Pick random or any other face from list
-            if self.current_face_index == -1:
-                self.current_face_index = 0
-            else:
-                self.current_face_index += 1
-                if self.current_face_index >= len(self.state.faces):
-                    self.current_face_index = 0
+            # Pick face with highest score, faces not looked at for a while score higher
+            scores = self.scorer.scores(self.last_tick, self.config)
+            index = int(np.argmax(scores))
+            if not np.isfinite(scores[index]):
+                index = -1
+        if index < 0:
+            # no face with valid position
+            self.current_face_id = None
+            return
+        self.current_face_id = self.state.faces[index].id
+        self.last_switch = self.last_tick
+
+    def SalientFaceWaiting(self):
+        # True if other face scores much higher than current one
+        if self.lookat == LookAt.NEAREST_FACE or len(self.state.faces) == 0:
+            return False
+        current = self.observations.faces_by_id.get(self.current_face_id)
+        if current is None:
+            return True
+        scores = self.scorer.scores(self.last_tick, self.config)
+        return scores.max() > scores[current] + SCORE_SWITCH_MARGIN
 
     def SelectNextPose(self):
         # switch to the next (or first) face
@@ -297,57 +946,93 @@ class Attention:
             return False
         # Select nearest pose to the robot, otherwise select nearest pose to previous
         if self.last_pose is None or self.last_pose_counter <= 0:
-            i, p = min(enumerate(self.state.poses),
-                                         key=lambda f: (f[1].position.x**2+f[1].position.y**2))
-            self.last_pose_counter = self.synthesizer_rate * self.min_time_between_targets
+            i = Observations.nearest(self.observations.pose_positions)
+            self.last_pose_counter = self.min_time_between_targets
+        elif self.last_pose_observations is self.observations:
+            # No new message since last tick, nearest pose to previous is the previous one
+            self.last_pose_counter -= self.tick_time
+            return self.last_pose
         else:
-            i, p = min(enumerate(self.state.poses),
-                                         key=lambda f: ((self.last_pose.position.x - f[1].position.x)**2+
-                                                        (self.last_pose.position.y - f[1].position.y)**2+
-                                                        (self.last_pose.position.z - f[1].position.z)**2))
-            self.last_pose_counter -= 1
+            last = self.last_pose.position
+            i = Observations.nearest(self.observations.pose_positions, (last.x, last.y, last.z))
+            self.last_pose_counter -= self.tick_time
+        if i < 0:
+            self.last_pose_counter = 0
+            return False
+        p = self.state.poses[i]
         self.last_pose = p
+        self.last_pose_observations = self.observations
         return p
 
 
     def SelectNextSalientPoint(self):
-
-        # switch to the next (or first) saliency vector
-        if (self.state == None):
-            self.current_saliency_index = -1
-        if len(self.state.salientpoints) == 0:
-            # there are no saliency vectors, so select none
-            self.current_saliency_index = -1
+        # switch to the strongest recent salient point, other than current one. Returns False if there is none
+        target = self.saliency.select(self.last_tick, self.keep_time, self.saliency_target)
+        if target is None:
+            # keep looking at current point if it is the only one
+            target = self.saliency.select(self.last_tick, self.keep_time)
+        self.saliency_target = target
+        return target is not None
+
+
+    def TrackSalientPoint(self):
+        # current target follows nearest point of new perception message, if it did not move too far
+        if self.saliency_target is None:
             return
-        if self.current_saliency_index == -1:
-            self.current_saliency_index = 0
-        else:
-            self.current_saliency_index += 1
-            if self.current_saliency_index >= len(self.state.salientpoints):
-                self.current_saliency_index = 0
+        i = Observations.nearest(self.observations.saliency_positions, self.saliency_target)
+        if i >= 0:
+            p = self.observations.saliency_positions[i]
+            if np.sum((p - self.saliency_target) ** 2) < SALIENCY_TRACK_RADIUS ** 2:
+                self.saliency_target = p
+
+
+    def StepAvoid(self, ts):
+        # each perception message is added to occupancy grid once, transform is already cached for the tick
+        if self.avoid_observations is not self.observations:
+            self.avoid_observations = self.observations
+            obs = self.observations
+            points = np.concatenate([obs.face_positions, obs.pose_positions, obs.saliency_positions])
+            try:
+                self.avoid.update(self.transforms.transform(points, 'robot', ts), obs.time, self.keep_time)
+            except Exception as e:
+                logger.warn("Avoid update exception: {}".format(e))
+        # keep looking in the same direction until it gets occupied or it is time to look elsewhere
+        self.avoid_counter -= self.tick_time
+        if self.avoid_target is None or self.avoid_counter <= 0 or self.avoid.occupied(self.avoid_target):
+            self.avoid_target = self.avoid.best
+            self.avoid_counter = self.min_time_between_targets
+        d = self.avoid.directions[self.avoid_target]
+        self.UpdateGaze(Point(x=d[0], y=d[1], z=d[2]), ts, frame_id='blender')
 
 
     def SelectNextRegion(self):
-        # Check if setperformance has set regions
-        regions = rospy.get_param("/{}/performance_regions".format(self.robot_name), {})
-        if len(regions) == 0:
-            regions = rospy.get_param("/{}/regions".format(self.robot_name), {})
-        point = AttentionRegion.get_point_from_regions(regions, REGIONS[self.attention_region])
-        return Point(x=point['x'], y=point['y'], z=point['z'])
+        # Regions are cached, performance regions take priority if set
+        return self.regions.get_point(self.attention_region)
 
 
-    def StepLookAtFace(self, ts):
+    def PredictFacePosition(self, face):
+        # Filter is updated with time the face was captured, and predicts face position at tick time,
+        # covering perception latency
+        if self.face_filter.id != face.id:
+            self.face_filter.reset(face.id)
+        t = self.observations.capture_time(face.ts)
+        if self.face_filter.t is None or t > self.face_filter.t:
+            self.face_filter.update(np.array([face.position.x, face.position.y, face.position.z]), t)
+        p = self.face_filter.predict(self.last_tick)
+        if p is None:
+            return face.position
+        return Point(x=p[0], y=p[1], z=p[2])
 
-        if self.current_face_index == -1:
-            raise Exception("No face available")
 
-        try:
-            curface = self.state.faces[self.current_face_index]
-        except:
+    def StepLookAtFace(self, ts):
+
+        curface = self.observations.face(self.current_face_id)
+        if curface is None:
             raise Exception("No face available")
 
         self.ChangeTarget(curface.fsdk_id)
-        face_pos = curface.position
+        self.scorer.looked_at(curface.id, self.last_tick)
+        face_pos = self.PredictFacePosition(curface)
 
         # ==== handle eyecontact (only for LookAt.ONE_FACE and LookAt.ALL_FACES)
 
@@ -383,8 +1068,8 @@ class Attention:
 
         elif self.eyecontact == EyeContact.BOTH_EYES:
             # switch between eyes back and forth
-            self.eyes_counter -= 1
-            if self.eyes_counter == 0:
+            self.eyes_counter -= self.tick_time
+            if self.eyes_counter <= 0:
                 self.InitCounter("eyes", "eyes_time")
                 if self.current_eye == 1:
                     self.current_eye = 0
@@ -399,8 +1084,8 @@ class Attention:
 
         elif self.eyecontact == EyeContact.TRIANGLE:
             # cycle between eyes and mouth
-            self.eyes_counter -= 1
-            if self.eyes_counter == 0:
+            self.eyes_counter -= self.tick_time
+            if self.eyes_counter <= 0:
                 self.InitCounter("eyes", "eyes_time")
                 if self.current_eye == 2:
                     self.current_eye = 0
@@ -415,52 +1100,44 @@ class Attention:
                 cur_eye_pos = mouth_pos
             self.UpdateGaze(cur_eye_pos, ts)
 
-        # mirroring
-        # msg = pau()
-        # msg.m_coeffs = []
-        # msg.m_shapekeys = []
-
-        # if self.mirroring == Mirroring.EYEBROWS or self.mirroring == Mirroring.EYES or self.mirroring == Mirroring.MOUTH_EYEBROWS or self.mirroring == Mirroring.ALL:
-        #    # mirror eyebrows
-        #    left_brow = curface.left_brow
-        #    right_brow = curface.right_brow
-        #    msg.m_coeffs.append("brow_outer_UP.L")
-        #    msg.m_shapekeys.append(left_brow)
-        #    msg.m_coeffs.append("brow_inner_UP.L")
-        #    msg.m_shapekeys.append(left_brow * 0.8)
-        #    msg.m_coeffs.append("brow_outer_DN.L")
-        #    msg.m_shapekeys.append(1.0 - left_brow)
-        #    msg.m_coeffs.append("brow_outer_up.R")
-        #    msg.m_shapekeys.append(right_brow)
-        #    msg.m_coeffs.append("brow_inner_UP.R")
-        #    msg.m_shapekeys.append(right_brow * 0.8)
-        #    msg.m_coeffs.append("brow_outer_DN.R")
-        #    msg.m_shapekeys.append(1.0 - right_brow)
-
-        # if self.mirroring == Mirroring.EYELIDS or self.mirroring == Mirroring.EYES or self.mirroring == Mirroring.MOUTH_EYELIDS or self.mirroring == Mirroring.ALL:
-        #    # mirror eyelids
-        #    eyes_closed = ((1.0 - curface.left_eyelid) + (1.0 - curface.right_eyelid)) / 2.0
-        #    msg.m_coeffs.append("eye-blink.UP.R")
-        #    msg.m_shapekeys.append(eyes_closed)
-        #    msg.m_coeffs.append("eye-blink.UP.L")
-        #    msg.m_shapekeys.append(eyes_closed)
-        #    msg.m_coeffs.append("eye-blink.LO.R")
-        #    msg.m_shapekeys.append(eyes_closed)
-        #    msg.m_coeffs.append("eye-blink.LO.L")
-        #    msg.m_shapekeys.append(eyes_closed)
-
-        # if self.mirroring == Mirroring.MOUTH or self.mirroring == Mirroring.MOUTH_EYEBROWS or self.mirroring == Mirroring.MOUTH_EYELIDS:
-        #    # mirror mouth
-        #    mouth_open = curface.mouth_open
-        #    msg.m_coeffs.append("lip-JAW.DN")
-        #    msg.m_shapekeys.append(mouth_open)
-
-        # if self.mirroring != Mirroring.IDLE:
-        #    self.StartPauMode()
-        #    self.setpau_pub.publish(msg)
+        # mirroring, pau mode is started when mirroring is enabled
+        if self.mirroring != Mirroring.IDLE:
+            msg = self.mirror.step(curface, self.last_tick, self.tick_time)
+            if msg is not None:
+                self.Publish(self.setpau_pub, msg)
 
 
+    @instrumented('attention: HandleTimer')
     def HandleTimer(self, data):
+        start = monotonic()
+        # counters are decremented by actual time since last tick, so late or missed ticks don't stretch timings
+        if self.last_tick is not None:
+            self.tick_time = max(0.0, min(start - self.last_tick, MAX_TICK_TIME))
+        self.last_tick = start
+        # tf lookup is done before the lock is taken and publishing after it is released
+        self.transforms.prefetch('robot', data.current_expected)
+        try:
+            self.StepSynthesizer(data)
+        finally:
+            self.FlushOutbox()
+        lateness = (data.current_real - data.current_expected).to_sec() if data.current_expected else 0
+        self.tick_stats.add(monotonic() - start, max(0, lateness))
+        if start - self.diagnostics_time > DIAGNOSTICS_TIME:
+            self.diagnostics_time = start
+            self.PublishDiagnostics()
+
+
+    def PublishDiagnostics(self):
+        status = self.tick_stats.status()
+        status.values += self.lock.report()
+        status.values += self.output.report()
+        msg = DiagnosticArray()
+        msg.header.stamp = rospy.Time.now()
+        msg.status = [status]
+        self.diagnostics_pub.publish(msg)
+
+
+    def StepSynthesizer(self, data):
         looking_at_face = False
         with self.lock:
             if not self.configs_init:
@@ -468,8 +1145,13 @@ class Attention:
             if not self.enable_flag:
 
                 self.ChangeTarget(-1)
+                self.output.discard_targets()
                 return False
 
+            # pick up latest perception snapshot
+            if self.latest_observations is not self.observations:
+                self.UpdateObservations(self.latest_observations)
+
             # this is the heart of the synthesizer, here the lookat and eyecontact state machines take care of where the robot is looking, and random expressions and gestures are triggered to look more alive (like RealSense Tracker)
             ts = data.current_expected
             #If nowhere to look, straighten the head
@@ -480,32 +1162,31 @@ class Attention:
             idle =False
             # ==== handle lookat
             if self.lookat == LookAt.AVOID:
-                # TODO: find out where there is no saliency, hand or face
-                # TODO: head_focus_pub
-                ()
+                self.StepAvoid(ts)
 
             if self.lookat == LookAt.HOLD or self.lookat == LookAt.IDLE:
-                # Do nothing
-                pass
-
-            # if self.lookat == LookAt.SALIENCY:
-            #     self.saliency_counter -= 1
-            #     if self.saliency_counter == 0:
-            #         self.SelectNextSalientPoint()
-            #         # Reset head position if nothing happens
-            #         if self.current_saliency_index == -1:
-            #             self.UpdateGaze(idle_point, ts, frame_id='blender')
-            #         else:
-            #             # Init counter only if any salient point found
-            #             self.InitCounter("saliency","saliency_time")
-            #
-            #     if self.current_saliency_index != -1:
-            #         cursaliency = self.state.salientpoints[self.current_saliency_index]
-            #         self.UpdateGaze(cursaliency.position, ts)
+                # Do nothing, and don't finish moves of previous state. Flush runs in this thread after the
+                # tick, so targets can't be published between lookat change and this point
+                self.output.discard_targets()
+
+            elif self.lookat == LookAt.SALIENCY:
+                self.saliency_counter -= self.tick_time
+                # selection waits for next tick if this one is already over budget
+                if self.saliency_counter <= 0 and monotonic() - self.last_tick < SALIENCY_TICK_BUDGET:
+                    # Init counter only if any salient point found
+                    if self.SelectNextSalientPoint():
+                        self.InitCounter("saliency","saliency_time")
+                    else:
+                        # Reset head position if nothing happens
+                        self.UpdateGaze(idle_point, ts, frame_id='blender')
+
+                if self.saliency_target is not None:
+                    p = self.saliency_target
+                    self.UpdateGaze(Point(x=p[0], y=p[1], z=p[2]), ts)
 
             elif self.lookat == LookAt.REGION:
-                self.region_counter -= 1
-                if self.region_counter == 0:
+                self.region_counter -= self.tick_time
+                if self.region_counter <= 0:
                     self.InitCounter("region", "region_time")
                     # SelectNextRegion returns idle point if no region set
                     point = self.SelectNextRegion()
@@ -515,19 +1196,22 @@ class Attention:
             #     pose = self.SelectNextPose()
             #     if pose:
             #         self.UpdateGaze(pose.position, ts)
-            #         self.no_switch_counter = self.synthesizer_rate * self.min_time_between_targets
+            #         self.no_switch_counter = self.min_time_between_targets
             #     else:
-            #         self.no_switch_counter -= 1
+            #         self.no_switch_counter -= self.tick_time
             #         if self.no_switch_counter < 0:
             #             point = self.SelectNextRegion()
             #             self.UpdateGaze(point, ts, frame_id='blender')
-            #             self.no_switch_counter = self.synthesizer_rate * self.min_time_between_targets
+            #             self.no_switch_counter = self.min_time_between_targets
             else:
                 if self.lookat == LookAt.ALL_FACES or self.lookat == LookAt.NEAREST_FACE or self.lookat == LookAt.POSES:
-                    self.faces_counter -= 1
-                    if self.faces_counter == 0:
+                    self.faces_counter -= self.tick_time
+                    # Switch when faces timer expires, or earlier if other face is much more salient,
+                    # but not sooner than min_time_between_targets after previous switch
+                    if self.last_tick - self.last_switch >= self.min_time_between_targets and \
+                            (self.faces_counter <= 0 or self.SalientFaceWaiting()):
                         self.SelectNextFace()
-                        self.no_switch_counter = self.synthesizer_rate * self.min_time_between_targets
+                        self.no_switch_counter = self.min_time_between_targets
                         self.InitCounter("faces", "faces_time")
                     try:
                         # This will make sure robot will look somewhere so eye contact only should be paused
@@ -540,22 +1224,22 @@ class Attention:
                     except:
                         # Look at poses if no faces are visible, and then look at region otherwise
                         pose = self.SelectNextPose()
-                        self.no_face_counter -= 1
+                        self.no_face_counter -= self.tick_time
                         if pose:
                             self.UpdateGaze(pose.position, ts)
-                            self.no_switch_counter = self.synthesizer_rate * self.min_time_between_targets
+                            self.no_switch_counter = self.min_time_between_targets
                         else:
-                            self.no_switch_counter -= 1
+                            self.no_switch_counter -= self.tick_time
                             if self.no_switch_counter <= 0:
                                 if self.no_face_counter <= 0:
                                     point = self.SelectNextRegion()
                                     self.InitCounter('no_face', 'region_time')
                                     self.UpdateGaze(point, ts, frame_id='blender')
-                                    self.no_switch_counter = self.synthesizer_rate * self.min_time_between_targets
+                                    self.no_switch_counter = self.min_time_between_targets
 
             if self.lookat == LookAt.REGION or region:
-                self.region_counter -= 1
-                if self.region_counter == 0:
+                self.region_counter -= self.tick_time
+                if self.region_counter <= 0:
                     # Eye contact enabled when looking at region
                     if self.eyecontact > 0:
                         looking_at_face = True
@@ -571,8 +1255,8 @@ class Attention:
                         idle = True
 
             # if self.lookat == LookAt.IDLE or idle:
-            #     self.rest_counter -= 1
-            #     if self.rest_counter == 0:
+            #     self.rest_counter -= self.tick_time
+            #     if self.rest_counter <= 0:
             #         self.InitCounter("rest", "rest_time")
             #         if self.eyecontact > 0:
             #             looking_at_face = True
@@ -586,29 +1270,29 @@ class Attention:
             # have gaze or head follow head or gaze after a while
             if self.gaze_delay_counter > 0 and self.gaze_pos != None:
 
-                self.gaze_delay_counter -= 1
-                if self.gaze_delay_counter == 0:
+                self.gaze_delay_counter -= self.tick_time
+                if self.gaze_delay_counter <= 0:
 
                     if self.gaze == Gaze.GAZE_LEADS_HEAD:
                         self.SetHeadFocus(self.gaze_pos, self.gaze_speed,ts)
-                        self.gaze_delay_counter = int(self.gaze_delay * self.synthesizer_rate)
+                        self.gaze_delay_counter = self.gaze_delay
 
                     elif self.gaze == Gaze.HEAD_LEADS_GAZE:
                         self.SetGazeFocus(self.gaze_pos, self.gaze_speed,ts)
-                        self.gaze_delay_counter = int(self.gaze_delay * self.synthesizer_rate)
+                        self.gaze_delay_counter = self.gaze_delay
 
             # when speaking, sometimes look at all faces
             # if self.interrupt_to_all_faces:
             #
             #     if self.interrupting:
-            #         self.all_faces_duration_counter -= 1
+            #         self.all_faces_duration_counter -= self.tick_time
             #         if self.all_faces_duration_counter <= 0:
             #             self.interrupting = False
             #             self.InitCounter("all_faces_duration", "all_faces_duration")
             #             self.SetLookAt(self.interrupted_state)
             #             self.UpdateStateDisplay()
             #     else:
-            #         self.all_faces_start_counter -= 1
+            #         self.all_faces_start_counter -= self.tick_time
             #         if self.all_faces_start_counter <= 0:
             #             self.interrupting = True
             #             self.InitCounter("all_faces_start", "all_faces_start_time")
@@ -668,16 +1352,17 @@ class Attention:
 
 
     def SetMirroring(self, newmirroring):
-        pass
-        # logger.warn("SetMirroring {}".format(newmirroring))
-        # if newmirroring == self.mirroring: return
-        #
-        # self.mirroring = newmirroring
-        #
-        # if self.mirroring == Mirroring.IDLE:
-        #     self.StopPauMode()
-        # else:
-        #     self.StartPauMode()
+
+        if newmirroring == self.mirroring:
+            return
+
+        self.mirroring = newmirroring
+        self.mirror.set_mode(newmirroring)
+
+        if self.mirroring == Mirroring.IDLE:
+            self.StopPauMode()
+        else:
+            self.StartPauMode()
 
 
     def SetGaze(self, newgaze):
@@ -688,34 +1373,33 @@ class Attention:
         self.gaze = newgaze
 
         if self.gaze == Gaze.GAZE_LEADS_HEAD or self.gaze == Gaze.HEAD_LEADS_GAZE:
-            self.gaze_delay_counter = int(self.gaze_delay * self.synthesizer_rate)
+            self.gaze_delay_counter = self.gaze_delay
 
 
+    @instrumented('attention: HandleState')
     def HandleState(self, data):
-        with self.lock:
+        # snapshot is built without the lock and swapped in, synthesizer picks it up on next tick
+        self.latest_observations = Observations(data)
 
-            self.state = data
 
-            # if there is a wanted face, try to find it and use that
-            if self.wanted_face_id != 0:
-                index = 0
-                self.current_face_index = -1
-                for face in self.state.faces:
-                    if face.id == self.wanted_face_id:
-                        self.current_face_index = index
-                        break
-                    index += 1
+    def UpdateObservations(self, observations):
+        self.observations = observations
+        self.state = observations.state
+        self.scorer.update(observations)
 
-            # otherwise, just make sure current_face_index is valid
-            elif (self.current_face_index >= len(self.state.faces)) or (self.current_face_index == -1):
-                # Only try to look at new faces once there are no
-                if self.no_switch_counter <= 0:
-                    self.SelectNextFace()
-            # TODO: it's better to have the robot look at the same ID, regardless of which index in the stateface list
+        # if there is a wanted face, try to find it and use that
+        if self.wanted_face_id != 0:
+            self.current_face_id = self.wanted_face_id if self.wanted_face_id in self.observations.faces_by_id else None
 
-            # # if there is no current saliency or the current saliency is out of range, select a new current saliency
-            # if (self.current_saliency_index >= len(self.state.salientpoints)) or (self.current_saliency_index == -1):
-            #     self.SelectNextSaliency()
+        # otherwise keep looking at the same ID, and select new face only if current one is gone
+        elif self.current_face_id not in self.observations.faces_by_id:
+            # Only try to look at new faces once there are no
+            if self.no_switch_counter <= 0:
+                self.SelectNextFace()
+
+        if self.lookat == LookAt.SALIENCY:
+            self.saliency.add(observations, self.keep_time)
+            self.TrackSalientPoint()
 
 
     def HandleEyeContact(self,data):
@@ -746,7 +1430,7 @@ class Attention:
 
         with self.lock:
 
-            self.SetMirroring(data)
+            self.SetMirroring(data.data)
 
         self.UpdateStateDisplay()
 
@@ -762,5 +1446,6 @@ class Attention:
 
 if __name__ == "__main__":
     rospy.init_node('attention')
+    instrumentation.start()
     node = Attention()
     rospy.spin()
@@ -0,0 +1,37 @@
+#!/usr/bin/env python
+# Runs attention, animations and states in single process. Config pushes from states to attention and
+# animations are direct calls to their config servers instead of dynamic reconfigure service calls.
+import rospy
+
+import instrumentation
+
+from attention import Attention
+from animation import Animations
+from states import Robot
+
+
+class LocalClient:
+    """ Same interface as dynamic reconfigure client, for server running in this process"""
+
+    def __init__(self, server):
+        self.server = server
+
+    @property
+    def config(self):
+        return self.server.config
+
+    def update_configuration(self, changes):
+        return self.server.update_configuration(changes)
+
+
+if __name__ == "__main__":
+    rospy.init_node("behavior")
+    instrumentation.start()
+    attention = Attention()
+    animations = Animations()
+    robot = Robot(clients={
+        'attention': LocalClient(attention.config_server),
+        'animation': LocalClient(animations.animations),
+    })
+    # Animations scheduler runs in main thread until shutdown
+    animations.run()
@@ -0,0 +1,162 @@
+#!/usr/bin/env python
+# Benchmarks state machine transitions without ROS master. Services, publishers, subscribers, timers,
+# parameters and dynamic reconfigure servers/clients are replaced by local stand-ins, which can simulate
+# ROS call latency. Scripted conversations and performances are driven through the Robot callbacks and
+# transitions per second, hook latency and time each callback blocks its thread are reported.
+#
+#   bench_states.py --conversations 500 --client-latency 2 --param-latency 1
+import argparse
+import random
+import time
+import timeit
+
+import rospy
+from dynamic_reconfigure.encoding import Config
+from hr_msgs.msg import ChatMessage
+from hr_msgs.msg import Event as PerformanceEvent
+from std_msgs.msg import String
+
+import states
+from stand_ins import FakeServer, FakeSubscriber, FakeTimer, percentiles
+
+PARAMS = {'/robot_name': 'robot', '~preload_state_configs': False}
+LATENCY = {'client': 0.0, 'param': 0.0}
+COUNTS = {'client calls': 0, 'set_param calls': 0, 'service calls': 0, 'published': 0}
+
+
+class FakePublisher:
+    def __init__(self, *args, **kwargs):
+        pass
+
+    def publish(self, *args, **kwargs):
+        COUNTS['published'] += 1
+
+
+class FakeService:
+    def __init__(self, *args, **kwargs):
+        pass
+
+    def __call__(self, *args, **kwargs):
+        COUNTS['service calls'] += 1
+
+
+class FakeClient:
+    """ Dynamic reconfigure client of remote node, each call takes simulated service latency"""
+
+    def __init__(self, config_type):
+        self.config = Config(config_type.defaults)
+
+    def update_configuration(self, changes):
+        COUNTS['client calls'] += 1
+        time.sleep(LATENCY['client'])
+        self.config.update(changes)
+        return self.config
+
+
+def set_param(name, value):
+    COUNTS['set_param calls'] += 1
+    time.sleep(LATENCY['param'])
+    PARAMS[name] = value
+
+
+def performances_tree(count):
+    """ Performances with keywords, similar to webui performances param"""
+    return {'shared': dict(('timeline{}'.format(i), {'properties': {'keywords': ['keyword{}'.format(i)]}})
+                           for i in range(count))}
+
+
+class Timings:
+    def __init__(self):
+        self.values = {}
+
+    def add(self, name, value):
+        self.values.setdefault(name, []).append(value)
+
+    def timed(self, name, fn, *args, **kwargs):
+        start = timeit.default_timer()
+        try:
+            return fn(*args, **kwargs)
+        finally:
+            self.add(name, timeit.default_timer() - start)
+
+    def wrap(self, cls, method):
+        # Machine keeps bound hooks, so they have to be wrapped before Robot is created
+        original = getattr(cls, method)
+        timings = self
+
+        def wrapper(robot, *args, **kwargs):
+            return timings.timed(method, original, robot, *args, **kwargs)
+        setattr(cls, method, wrapper)
+
+    def report(self):
+        for name, values in sorted(self.values.items()):
+            print('{}: {} calls, {}'.format(name, len(values), percentiles(values)))
+
+
+def install_stand_ins(args):
+    LATENCY['client'] = args.client_latency / 1000.0
+    LATENCY['param'] = args.param_latency / 1000.0
+    PARAMS['/robot/webui/performances'] = performances_tree(args.performances)
+    rospy.get_param = lambda name, default=None: PARAMS.get(name, default)
+    rospy.get_param_cached = lambda name: PARAMS[name]
+    rospy.set_param = set_param
+    rospy.wait_for_service = lambda *args, **kwargs: None
+    rospy.ServiceProxy = FakeService
+    rospy.Publisher = FakePublisher
+    rospy.Subscriber = FakeSubscriber
+    rospy.Timer = FakeTimer
+    rospy.rostime.set_rostime_initialized(True)
+    states.Server = FakeServer
+
+
+def conversation(robot, timings, args):
+    timings.timed('chat_events_cb', robot.chat_events_cb, String('speechstart'))
+    utterance = 'say keyword{}'.format(random.randrange(args.performances)) \
+        if random.random() < args.keyword_ratio else 'how are you today'
+    timings.timed('speech_cb', robot.speech_cb, ChatMessage(utterance=utterance))
+    timings.timed('speech_events_cb', robot.speech_events_cb, String('start'))
+    timings.timed('speech_events_cb', robot.speech_events_cb, String('stop'))
+
+
+def performance(robot, timings):
+    timings.timed('performance_cb', robot.performance_cb, String('shared/timeline0'))
+    for event in ['running', 'paused', 'resume', 'finished']:
+        timings.timed('performance_events_cb', robot.performance_events_cb, PerformanceEvent(event=event))
+    timings.timed('performance_cb', robot.performance_cb, String('null'))
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description='Benchmark states machine transitions')
+    parser.add_argument('--conversations', type=int, default=500, help='scripted speech exchanges')
+    parser.add_argument('--performance-every', type=int, default=10, help='run performance every n conversations')
+    parser.add_argument('--performances', type=int, default=300, help='performances with keywords')
+    parser.add_argument('--keyword-ratio', type=float, default=0.0,
+                        help='share of utterances matching a performance keyword')
+    parser.add_argument('--client-latency', type=float, default=0, help='simulated config push latency (ms)')
+    parser.add_argument('--param-latency', type=float, default=0, help='simulated set_param latency (ms)')
+    parser.add_argument('--seed', type=int, default=0)
+    args = parser.parse_args()
+    random.seed(args.seed)
+    install_stand_ins(args)
+
+    timings = Timings()
+    for hook in ['state_changed', 'on_before_state_change', 'push_config']:
+        timings.wrap(states.Robot, hook)
+    robot = states.Robot(clients={
+        'attention': FakeClient(states.AttentionConfig),
+        'animation': FakeClient(states.AnimationConfig),
+    })
+    # Default init state is interacting
+    robot.start_interacting()
+    timings.values = {}
+    start = timeit.default_timer()
+    for i in range(args.conversations):
+        conversation(robot, timings, args)
+        if args.performance_every and i % args.performance_every == args.performance_every - 1:
+            performance(robot, timings)
+            robot.start_interacting()
+    elapsed = timeit.default_timer() - start
+    transitions = len(timings.values.get('state_changed', []))
+    print('{} transitions in {:.3f} s, {:.0f} transitions/s'.format(transitions, elapsed, transitions / elapsed))
+    print(', '.join('{} {}'.format(k, v) for k, v in sorted(COUNTS.items())))
+    timings.report()
@@ -0,0 +1,31 @@
+# Monotonic clock shared by attention timings and state timeouts
+import os
+import time
+import ctypes
+import ctypes.util
+
+
+class timespec(ctypes.Structure):
+    _fields_ = [('tv_sec', ctypes.c_long), ('tv_nsec', ctypes.c_long)]
+
+
+def monotonic_clock():
+    """ time.monotonic, or clock_gettime(CLOCK_MONOTONIC) from libc on Python 2"""
+    if hasattr(time, 'monotonic'):
+        return time.monotonic
+    libc = ctypes.CDLL(ctypes.util.find_library('rt') or ctypes.util.find_library('c'), use_errno=True)
+    clock_gettime = libc.clock_gettime
+    clock_gettime.argtypes = [ctypes.c_int, ctypes.POINTER(timespec)]
+    CLOCK_MONOTONIC = 1
+
+    def monotonic():
+        t = timespec()
+        if clock_gettime(CLOCK_MONOTONIC, ctypes.byref(t)) != 0:
+            errno = ctypes.get_errno()
+            raise OSError(errno, os.strerror(errno))
+        return t.tv_sec + t.tv_nsec * 1e-9
+    return monotonic
+
+
+# Clock for timings and deadlines, not affected by system time changes
+monotonic = monotonic_clock()
@@ -0,0 +1,218 @@
+# Call counts and latency histograms for node callbacks, and on-demand sampling profiler.
+# Instrumented callbacks cost a single flag check while disabled. When enabled, statistics are published
+# on /behavior/diagnostics. Services (in node namespace):
+#   ~instrumentation (std_srvs/SetBool) - enables or disables timing of instrumented callbacks
+#   ~profile (std_srvs/Trigger) - samples stacks of all threads for ~profile_duration seconds, returns hot spots
+import sys
+import time
+import bisect
+import logging
+import threading
+import functools
+import collections
+
+import rospy
+from std_srvs.srv import SetBool, SetBoolResponse, Trigger, TriggerResponse
+from diagnostic_msgs.msg import DiagnosticArray, DiagnosticStatus, KeyValue
+
+logger = logging.getLogger('hr.r2_behavior.instrumentation')
+
+# How often (s) statistics are published while enabled
+DIAGNOSTICS_TIME = 5.0
+# Histogram bins for callback latency (ms)
+LATENCY_BINS = [1, 2, 5, 10, 20, 50, 100]
+# Profiler sampling interval (s) and number of functions reported
+PROFILE_INTERVAL = 0.005
+PROFILE_TOP = 20
+
+
+class Histogram:
+    """ Counts values within bins, last bin is open ended"""
+
+    def __init__(self, name, edges):
+        self.name = name
+        self.edges = edges
+        self.reset()
+
+    def reset(self):
+        self.counts = [0] * (len(self.edges) + 1)
+
+    def add(self, value):
+        self.counts[bisect.bisect_right(self.edges, value)] += 1
+
+    def report(self):
+        labels = ['<{}'.format(e) for e in self.edges] + ['>={}'.format(self.edges[-1])]
+        values = [KeyValue('{} {}'.format(self.name, l), str(c)) for l, c in zip(labels, self.counts)]
+        self.reset()
+        return values
+
+
+class CallStats:
+    """ Calls count and latency of single callback since last report"""
+
+    def __init__(self, name):
+        self.name = name
+        self.lock = threading.Lock()
+        self.latency = Histogram('latency (ms)', LATENCY_BINS)
+        self.reset()
+
+    def reset(self):
+        self.count = 0
+        self.errors = 0
+        self.total = 0.0
+        self.max = 0.0
+        self.latency.reset()
+
+    def add(self, latency, failed):
+        with self.lock:
+            self.count += 1
+            self.errors += failed
+            self.total += latency
+            self.max = max(self.max, latency)
+            self.latency.add(1000.0 * latency)
+
+    def status(self):
+        status = DiagnosticStatus()
+        status.name = self.name
+        status.hardware_id = 'behavior'
+        with self.lock:
+            mean = 1000.0 * self.total / self.count if self.count > 0 else 0.0
+            if self.errors > 0:
+                status.level = DiagnosticStatus.WARN
+                status.message = '{} of {} calls failed'.format(self.errors, self.count)
+            else:
+                status.level = DiagnosticStatus.OK
+                status.message = '{} calls'.format(self.count)
+            status.values = [
+                KeyValue('calls', str(self.count)),
+                KeyValue('errors', str(self.errors)),
+                KeyValue('mean (ms)', '{:.2f}'.format(mean)),
+                KeyValue('max (ms)', '{:.2f}'.format(1000.0 * self.max)),
+            ] + self.latency.report()
+            self.reset()
+        return status
+
+
+class Instrumentation:
+    """ Registry of instrumented callbacks, one per process"""
+
+    def __init__(self):
+        self.enabled = False
+        self.stats = []
+        self.started = False
+        self.profiling = threading.Lock()
+        self.diagnostics_pub = None
+        self.timer = None
+
+    def instrumented(self, name):
+        """ Decorator which records calls count and latency of the function under given name"""
+        stats = CallStats(name)
+        self.stats.append(stats)
+
+        def decorator(fn):
+            @functools.wraps(fn)
+            def wrapper(*args, **kwargs):
+                if not self.enabled:
+                    return fn(*args, **kwargs)
+                start = time.time()
+                failed = True
+                try:
+                    result = fn(*args, **kwargs)
+                    failed = False
+                    return result
+                finally:
+                    stats.add(time.time() - start, failed)
+            return wrapper
+        return decorator
+
+    def start(self):
+        """ Creates publisher and services, should be called once node is initialized"""
+        if self.started:
+            return
+        self.started = True
+        self.diagnostics_pub = rospy.Publisher('/behavior/diagnostics', DiagnosticArray, queue_size=5)
+        rospy.Service('~instrumentation', SetBool, self.enable_callback)
+        rospy.Service('~profile', Trigger, self.profile_callback)
+        self.enable(rospy.get_param('~instrumentation', False))
+
+    def enable(self, enabled):
+        if enabled == self.enabled:
+            return
+        if enabled:
+            for s in self.stats:
+                with s.lock:
+                    s.reset()
+            self.timer = rospy.Timer(rospy.Duration.from_sec(DIAGNOSTICS_TIME), self.publish)
+        else:
+            self.timer.shutdown()
+            self.timer = None
+        self.enabled = enabled
+
+    def publish(self, event=None):
+        if not self.enabled:
+            return
+        msg = DiagnosticArray()
+        msg.header.stamp = rospy.Time.now()
+        msg.status = [s.status() for s in self.stats]
+        self.diagnostics_pub.publish(msg)
+
+    def enable_callback(self, req):
+        self.enable(req.data)
+        return SetBoolResponse(True, 'instrumentation {}'.format('enabled' if req.data else 'disabled'))
+
+    def profile_callback(self, req):
+        # Only one snapshot at a time, sampling itself adds load
+        if not self.profiling.acquire(False):
+            return TriggerResponse(False, 'profiling already in progress')
+        try:
+            report = self.profile(rospy.get_param('~profile_duration', 5.0))
+        finally:
+            self.profiling.release()
+        logger.info(report)
+        return TriggerResponse(True, report)
+
+    @staticmethod
+    def profile(duration):
+        """ Samples stacks of all other threads. Returns functions with most own (running) and total samples"""
+        own = collections.Counter()
+        total = collections.Counter()
+        threads = collections.Counter()
+        samples = 0
+        me = threading.current_thread().ident
+        end = time.time() + duration
+        while time.time() < end:
+            names = dict((t.ident, t.name) for t in threading.enumerate())
+            for ident, frame in sys._current_frames().items():
+                if ident == me:
+                    continue
+                samples += 1
+                threads[names.get(ident, ident)] += 1
+                seen = set()
+                own[Instrumentation.frame_key(frame)] += 1
+                while frame is not None:
+                    key = Instrumentation.frame_key(frame)
+                    # Recursive functions are counted once per sample
+                    if key not in seen:
+                        seen.add(key)
+                        total[key] += 1
+                    frame = frame.f_back
+            time.sleep(PROFILE_INTERVAL)
+        if samples == 0:
+            return 'no samples'
+        lines = ['{} samples in {:.1f} s'.format(samples, duration), 'own samples:']
+        lines += ['{:6.1f}% {}'.format(100.0 * c / samples, k) for k, c in own.most_common(PROFILE_TOP)]
+        lines += ['total samples:']
+        lines += ['{:6.1f}% {}'.format(100.0 * c / samples, k) for k, c in total.most_common(PROFILE_TOP)]
+        lines += ['threads:']
+        lines += ['{:6.1f}% {}'.format(100.0 * c / samples, k) for k, c in threads.most_common()]
+        return '\n'.join(lines)
+
+    @staticmethod
+    def frame_key(frame):
+        code = frame.f_code
+        return '{} ({}:{})'.format(code.co_name, code.co_filename, code.co_firstlineno)
+
+
+INSTRUMENTATION = Instrumentation()
+instrumented = INSTRUMENTATION.instrumented
+start = INSTRUMENTATION.start
@@ -0,0 +1,192 @@
+#!/usr/bin/env python
+# Replays perception states through the attention synthesizer without ROS master or tf tree.
+# ROS publishers, subscribers, timers, parameters, config server and tf are replaced by local stand-ins,
+# time is simulated, and latency of HandleState/HandleTimer, allocations and published messages are reported.
+# Allocations are net per call (allocated and not freed before the call returns): gc tracked containers, and
+# heap bytes from glibc malloc statistics, which include numpy array buffers. Works on Python 2 and 3.
+#
+# Synthetic crowds of 1, 10 and 100 faces:
+#   replay_attention.py --faces 1 10 100
+# Recorded perception:
+#   replay_attention.py --bag perception.bag --topic /sophia/perception/state
+import argparse
+import ctypes
+import ctypes.util
+import gc
+import math
+import random
+import timeit
+
+import rospy
+import tf
+from r2_perception.msg import State, Face
+
+import attention
+from stand_ins import FakeServer, FakeSubscriber, FakeTimer, percentiles
+
+
+class FakePublisher:
+    def __init__(self, name, data_class, **kwargs):
+        self.resolved_name = name
+        self.count = 0
+        PUBLISHERS.append(self)
+
+    def publish(self, *args, **kwargs):
+        self.count += 1
+
+
+class FakeListener:
+    """ Fixed robot to blender transform"""
+
+    def __init__(self, *args, **kwargs):
+        self.lookups = 0
+
+    def canTransform(self, target, source, ts):
+        return True
+
+    def lookupTransform(self, target, source, ts):
+        self.lookups += 1
+        return (0.0, 0.0, -0.5), (0.0, 0.0, 0.0, 1.0)
+
+
+class SimClock:
+    def __init__(self):
+        self.now = 0.0
+
+    def __call__(self):
+        return self.now
+
+
+class TimerEvent:
+    def __init__(self, t):
+        self.current_expected = rospy.Time.from_sec(t)
+        self.current_real = self.current_expected
+
+
+class mallinfo(ctypes.Structure):
+    _fields_ = [(name, ctypes.c_int) for name in (
+        'arena', 'ordblks', 'smblks', 'hblks', 'hblkhd', 'usmblks', 'fsmblks', 'uordblks', 'fordblks', 'keepcost')]
+
+
+LIBC = ctypes.CDLL(ctypes.util.find_library('c'))
+LIBC.mallinfo.restype = mallinfo
+
+
+def heap_used():
+    """ Bytes in use by malloc, in arenas and mmapped chunks"""
+    info = LIBC.mallinfo()
+    return info.uordblks + info.hblkhd
+
+
+PUBLISHERS = []
+PARAMS = {'/robot_name': 'robot'}
+
+
+def install_stand_ins(args):
+    PARAMS['~synthesizer_rate'] = args.rate
+    FakeServer.overrides = {'lookat_state': args.lookat, 'enable_flag': True}
+    rospy.get_param = lambda name, default=None: PARAMS.get(name, default)
+    rospy.get_param_cached = lambda name: PARAMS[name]
+    rospy.Publisher = FakePublisher
+    rospy.Subscriber = FakeSubscriber
+    rospy.Timer = FakeTimer
+    rospy.rostime.set_rostime_initialized(True)
+    tf.TransformListener = FakeListener
+    attention.Server = FakeServer
+    attention.monotonic = CLOCK
+
+
+def synthetic_states(faces, duration, rate):
+    """ Faces walking around in front of the robot"""
+    people = [(random.uniform(0.5, 3.0), random.uniform(-1.5, 1.5), random.uniform(0.1, 1.0),
+               random.uniform(0, 2 * math.pi)) for _ in range(faces)]
+    for i in range(int(duration * rate)):
+        t = float(i) / rate
+        state = State()
+        for n, (x, y, speed, phase) in enumerate(people):
+            f = Face()
+            f.id = n + 1
+            f.fsdk_id = n + 1
+            f.position.x = x + 0.2 * math.sin(speed * t + phase)
+            f.position.y = y + 0.3 * math.cos(speed * t + phase)
+            f.position.z = random.gauss(0, 0.01)
+            state.faces.append(f)
+        random.shuffle(state.faces)
+        yield t, state
+
+
+def bag_states(path, topic):
+    import rosbag
+    start = None
+    with rosbag.Bag(path) as bag:
+        for _, msg, ts in bag.read_messages(topics=[topic]):
+            start = ts.to_sec() if start is None else start
+            yield ts.to_sec() - start, msg
+
+
+def timed(fn, arg, latencies, objects, heap):
+    # gc is disabled while measuring, so generation 0 count is net number of gc tracked containers created
+    # and not freed. Objects without references (strings, numbers) are only counted in heap bytes, and only
+    # if they don't fit into pymalloc arenas already allocated
+    gc.disable()
+    before = gc.get_count()[0]
+    heap_before = heap_used()
+    start = timeit.default_timer()
+    fn(arg)
+    latencies.append(timeit.default_timer() - start)
+    heap.append(heap_used() - heap_before)
+    objects.append(gc.get_count()[0] - before)
+    gc.enable()
+
+
+def report(name, latencies, objects, heap):
+    count = max(1, len(latencies))
+    print('{}: {}, net gc objects {:.1f}, net heap {:.0f} B per call'.format(
+        name, percentiles(latencies), float(sum(objects)) / count, float(sum(heap)) / count))
+
+
+def replay(name, states, args):
+    del PUBLISHERS[:]
+    CLOCK.now = 0.0
+    node = attention.Attention()
+    state_latency, state_objects, state_heap = [], [], []
+    tick_latency, tick_objects, tick_heap = [], [], []
+    period = 1.0 / args.rate
+    ticks = 0
+    for t, state in states:
+        # run ticks due before the state arrives
+        while ticks * period <= t:
+            CLOCK.now = ticks * period
+            timed(node.HandleTimer, TimerEvent(CLOCK.now), tick_latency, tick_objects, tick_heap)
+            ticks += 1
+        CLOCK.now = t
+        timed(node.HandleState, state, state_latency, state_objects, state_heap)
+    print('== {}: {} ticks, {} states'.format(name, len(tick_latency), len(state_latency)))
+    report('HandleTimer', tick_latency, tick_objects, tick_heap)
+    report('HandleState', state_latency, state_objects, state_heap)
+    print('tf lookups: {}'.format(node.tf_listener.lookups))
+    for pub in PUBLISHERS:
+        if pub.count:
+            print('{}: {} messages'.format(pub.resolved_name, pub.count))
+
+
+CLOCK = SimClock()
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description='Replay perception states through attention synthesizer')
+    parser.add_argument('--faces', type=int, nargs='+', default=[1, 10, 100], help='synthetic faces count')
+    parser.add_argument('--duration', type=float, default=30, help='synthetic replay duration (s)')
+    parser.add_argument('--perception-rate', type=float, default=30, help='synthetic perception rate (Hz)')
+    parser.add_argument('--rate', type=float, default=30, help='synthesizer rate (Hz)')
+    parser.add_argument('--lookat', type=int, default=attention.LookAt.ALL_FACES, help='lookat state')
+    parser.add_argument('--bag', help='replay perception states from bag instead')
+    parser.add_argument('--topic', default='/robot/perception/state', help='perception state topic in bag')
+    parser.add_argument('--seed', type=int, default=0)
+    args = parser.parse_args()
+    random.seed(args.seed)
+    install_stand_ins(args)
+    if args.bag:
+        replay(args.bag, bag_states(args.bag, args.topic), args)
+    else:
+        for faces in args.faces:
+            replay('{} faces'.format(faces), synthetic_states(faces, args.duration, args.perception_rate), args)
@@ -0,0 +1,41 @@
+# Local stand-ins for ROS used by offline benchmarks (replay_attention.py, bench_states.py)
+from dynamic_reconfigure.encoding import Config
+
+
+class FakeSubscriber:
+    def __init__(self, *args, **kwargs):
+        pass
+
+
+class FakeTimer:
+    def __init__(self, *args, **kwargs):
+        pass
+
+    def shutdown(self):
+        pass
+
+
+class FakeServer:
+    """ Config server with generated defaults, updated with overrides"""
+    overrides = {}
+
+    def __init__(self, config_type, callback, namespace=''):
+        self.callback = callback
+        self.config = Config(config_type.defaults)
+        self.config.update(self.overrides)
+        self.config = callback(self.config, ~0)
+
+    def update_configuration(self, changes):
+        self.config.update(changes)
+        self.config = self.callback(self.config, ~0)
+        return self.config
+
+
+def percentiles(values):
+    """ Latency percentiles of values in seconds"""
+    values = sorted(values)
+    if not values:
+        return 'n/a'
+    pick = lambda p: 1000.0 * values[min(len(values) - 1, int(p * len(values)))]
+    return 'p50 {:.3f} ms, p90 {:.3f} ms, p99 {:.3f} ms, max {:.3f} ms'.format(
+        pick(0.5), pick(0.9), pick(0.99), 1000.0 * values[-1])
@@ -7,6 +7,10 @@ import yaml
 import subprocess
 import threading
 import time
+import sqlite3
+import json
+import heapq
+import copy
 
 import rospy
 from transitions.extensions import HierarchicalMachine
@@ -21,9 +25,15 @@ from hr_msgs.msg import Target, SomaState
 from performances.nodes import pause
 from r2_behavior.cfg import AttentionConfig, AnimationConfig, StatesConfig, StateConfig
 from std_msgs.msg import String, Bool, Float32
+from diagnostic_msgs.msg import DiagnosticArray, DiagnosticStatus, KeyValue
 import dynamic_reconfigure.client
 import performances.srv as srv
 
+import instrumentation
+from instrumentation import instrumented
+from wakeup import Wakeup
+from clock import monotonic
+
 logger = logging.getLogger('hr.behavior.states')
 
 # High level hierarchical state machine
@@ -49,6 +59,20 @@ ATTENTION = ['interacting_bored', 'interacting_interested', 'interacting_listeni
 # States to serve separate animation settings
 ANIMATIONS = ATTENTION
 
+# How often (s) known faces writer checks for new faces, and how often it writes updated last seen times
+FACES_WRITE_TIME = 1
+FACES_SYNC_TIME = 10
+# Minimum time (s) between checks of performances param for changed keywords
+KEYWORDS_CHECK_TIME = 1
+
+# Greetings for known faces, in order of priority: (time not seen (s), performance keyword)
+GREETINGS = [
+    (60*60*24, 'faceid_long_{}'),
+    (60*15, 'faceid_short_{}'),
+    (60*60*24, 'faceid_long_unknown'),
+    (60*15, 'faceid_short_unknown'),
+]
+
 # Defines transitions:
 # name, from states, to_states, [condition, unless]
 
@@ -80,49 +104,245 @@ TRANSITIONS = [
 class InteractiveState(NestedState):
     def __init__(self, name, on_enter=None, on_exit=None, ignore_invalid_triggers=None, parent=None, initial=None):
         NestedState.__init__(self, name, on_enter, on_exit, ignore_invalid_triggers, parent, initial)
-        # create dynamic reconfigure server
-        self.attention_config = {}
-        self.animations_config = {}
-        self.state_config = {}
-        node_name = name if parent is None else "{}_{}".format(parent.name, name)
-        if node_name in ATTENTION:
-            self.attention_server = Server(AttentionConfig, self.attention_callback,
-                                           namespace="/behavior/{}/attention".format(node_name))
-        if node_name in ANIMATIONS:
-            self.animation_server = Server(AnimationConfig, self.animations_callback,
-                                         namespace="/behavior/{}/animations".format(node_name))
-        self.state_server = Server(StateConfig, self.config_callback, namespace='/behavior/{}/settings'.format(node_name))
+        self._attention_config = {}
+        self._animations_config = {}
+        self._state_config = {}
+        self.node_name = name if parent is None else "{}_{}".format(parent.name, name)
+        # dynamic reconfigure servers are created on first use
+        self.servers_created = False
+        self.servers_lock = threading.Lock()
+
+    def create_servers(self):
+        # create dynamic reconfigure server, initial settings are loaded from param server
+        with self.servers_lock:
+            if self.servers_created:
+                return
+            if self.node_name in ATTENTION:
+                self.attention_server = Server(AttentionConfig, self.attention_callback,
+                                               namespace="/behavior/{}/attention".format(self.node_name))
+            if self.node_name in ANIMATIONS:
+                self.animation_server = Server(AnimationConfig, self.animations_callback,
+                                             namespace="/behavior/{}/animations".format(self.node_name))
+            self.state_server = Server(StateConfig, self.config_callback,
+                                       namespace='/behavior/{}/settings'.format(self.node_name))
+            self.servers_created = True
+
+    @property
+    def attention_config(self):
+        self.create_servers()
+        return self._attention_config
+
+    @property
+    def animations_config(self):
+        self.create_servers()
+        return self._animations_config
+
+    @property
+    def state_config(self):
+        self.create_servers()
+        return self._state_config
 
     def attention_callback(self, config, level):
-        self.attention_config = config
+        self._attention_config = config
         return config
 
     def animations_callback(self, config, level):
-        self.animations_config = config
+        self._animations_config = config
         return config
 
     def config_callback(self, config, level):
-        self.state_config = config
+        self._state_config = config
         return config
 
 
+class KeywordIndex:
+    """ Word trie over all performance keywords, matches whole utterance in one pass"""
+    WORDS = re.compile(r"\w+", flags=re.UNICODE)
+
+    def __init__(self):
+        self.performances = None
+        self.version = 0
+        self._trie = {}
+
+    @classmethod
+    def tokenize(cls, text):
+        return cls.WORDS.findall(text.lower())
+
+    def update(self, performances):
+        """ Rebuilds index if performances tree has changed. Returns True if rebuilt"""
+        if performances == self.performances:
+            return False
+        # Param cache updates nested values in place, so own copy is kept for comparison
+        performances = copy.deepcopy(performances)
+        trie = {}
+        for path, keywords in Robot.get_keywords(performances).items():
+            for keyword in keywords:
+                words = self.tokenize(keyword) if keyword else []
+                if not words:
+                    continue
+                node = trie
+                for w in words:
+                    node = node.setdefault(w, {})
+                node.setdefault(None, set()).add(path)
+        self._trie = trie
+        self.performances = performances
+        self.version += 1
+        return True
+
+    def match(self, speech):
+        """ Returns all performance paths having at least one keyword in speech"""
+        words = self.tokenize(speech)
+        matched = set()
+        for i in range(len(words)):
+            node = self._trie
+            for w in words[i:]:
+                node = node.get(w)
+                if node is None:
+                    break
+                if None in node:
+                    matched.update(node[None])
+        return list(matched)
+
+
+class KnownFaces:
+    """ Faces last seen times. Kept in memory, changes are written in batches to SQLite database"""
+
+    def __init__(self, db_file=None, legacy_file=None):
+        self.db_file = db_file
+        self.faces = {}
+        self.dirty = {}
+        self.new_faces = False
+        self.last_write = time.time()
+        self.lock = threading.Lock()
+        self._db = None
+        if db_file is None:
+            return
+        migrate = not os.path.exists(db_file)
+        self._db = sqlite3.connect(db_file, check_same_thread=False)
+        with self._db:
+            self._db.execute("CREATE TABLE IF NOT EXISTS faces (name TEXT PRIMARY KEY, last_seen REAL)")
+        if migrate and legacy_file and os.path.exists(legacy_file):
+            self.migrate(legacy_file)
+        self.faces = dict(self._db.execute("SELECT name, last_seen FROM faces"))
+
+    def migrate(self, legacy_file):
+        """ Imports faces from old YAML database"""
+        try:
+            with open(legacy_file, 'r') as stream:
+                faces = yaml.load(stream) or {}
+            with self._db:
+                self._db.executemany("INSERT OR REPLACE INTO faces VALUES (?, ?)",
+                                     [(name, f['last_seen']) for name, f in faces.items()])
+            logger.info("Imported {} known faces from {}".format(len(faces), legacy_file))
+        except Exception as e:
+            logger.warn("Can't import known faces {}".format(e))
+
+    def __contains__(self, name):
+        return name in self.faces
+
+    def last_seen(self, name):
+        return self.faces.get(name)
+
+    def seen(self, name, t):
+        with self.lock:
+            if name not in self.faces:
+                # New faces are written on next check
+                self.new_faces = True
+            self.faces[name] = t
+            self.dirty[name] = t
+
+    def write(self, event=None):
+        """ Writes changed faces in single transaction. Called from timer, so perception is never blocked"""
+        with self.lock:
+            if not self.dirty or self._db is None:
+                return
+            if not self.new_faces and self.last_write + FACES_SYNC_TIME > time.time():
+                return
+            dirty, self.dirty = self.dirty, {}
+            self.new_faces = False
+            self.last_write = time.time()
+        try:
+            with self._db:
+                self._db.executemany("INSERT OR REPLACE INTO faces VALUES (?, ?)", dirty.items())
+        except Exception as e:
+            logger.error("Can't write known faces {}".format(e))
+            with self.lock:
+                for name, t in dirty.items():
+                    self.dirty.setdefault(name, t)
+
+
+class StateTimers:
+    """ Runs all state timeouts from single thread. Each timeout gets unique handle, which is passed to
+    the callback, so callback can check that timeout is still the current one"""
+
+    def __init__(self):
+        # heap of (monotonic deadline, handle)
+        self.queue = []
+        # handle: callback, for timeouts not yet fired or cancelled
+        self.pending = {}
+        self.generation = 0
+        self.lock = threading.Lock()
+        self.wakeup = Wakeup()
+        self.thread = threading.Thread(target=self.run)
+        self.thread.daemon = True
+        self.thread.start()
+
+    def schedule(self, delay, callback):
+        with self.lock:
+            self.generation += 1
+            self.pending[self.generation] = callback
+            heapq.heappush(self.queue, (monotonic() + delay, self.generation))
+            handle = self.generation
+        self.wakeup.set()
+        return handle
+
+    def cancel(self, handle):
+        with self.lock:
+            self.pending.pop(handle, None)
+
+    def run(self):
+        while True:
+            callback = None
+            delay = None
+            with self.lock:
+                # Drop cancelled timeouts
+                while self.queue and self.queue[0][1] not in self.pending:
+                    heapq.heappop(self.queue)
+                if self.queue:
+                    delay = self.queue[0][0] - monotonic()
+                    if delay <= 0:
+                        handle = heapq.heappop(self.queue)[1]
+                        callback = self.pending.pop(handle)
+            if callback is None:
+                # Sleeps until next timeout is due or new one is scheduled
+                self.wakeup.wait(delay)
+                continue
+            try:
+                callback(handle)
+            except Exception as e:
+                logger.error("State timeout failed: {}".format(e))
+
 
 class Robot(HierarchicalMachine):
 
     state_cls = InteractiveState
 
-    def __init__(self):
-        # Wait for service to set initial params
-        rospy.wait_for_service('/current/attention/set_parameters')
-        rospy.wait_for_service('/current/animations/set_parameters')
+    def __init__(self, clients=None):
+        # Wait for service to set initial params, unless attention and animations clients are given (same process)
+        if clients is None:
+            rospy.wait_for_service('/current/attention/set_parameters')
+            rospy.wait_for_service('/current/animations/set_parameters')
         # Current state config
         self.state_config = None
         self.config = None
         self.starting = True
         # Current TTS mode: chatbot_responses - auto, web_sresponses - operator
         self.current_tts_mode = "chatbot_responses"
-        # Controls states_timeouts
+        # Controls states_timeouts, handle of current state timeout
         self._state_timer = None
+        # Reentrant, as timeout trigger runs transition hooks
+        self.state_timer_lock = threading.RLock()
+        self.timers = StateTimers()
         # ROS Topics and services
         self.robot_name = rospy.get_param('/robot_name')
         # ROS publishers
@@ -131,6 +351,7 @@ class Robot(HierarchicalMachine):
             'chatbot_speech': rospy.Publisher('/{}/chatbot_speech'.format(self.robot_name), ChatMessage, queue_size=10),
             'soma_pub': rospy.Publisher('/blender_api/set_soma_state', SomaState, queue_size=10),
             'state_pub': rospy.Publisher('/current_state', String, latch=True),
+            'diagnostics': rospy.Publisher('/behavior/diagnostics', DiagnosticArray, queue_size=5),
         }
         # ROS Subscribers
         self.subscribers = {
@@ -154,10 +375,16 @@ class Robot(HierarchicalMachine):
             'performance_runner': rospy.ServiceProxy('/performances/run_full_performance', srv.RunByName),
             'blender_param': rospy.ServiceProxy('/blender_api/set_param', SetParam),
         }
+        # Target name: config values last pushed to it
+        self.pushed = {}
         # Configure clients
-        self.clients = {
-            'attention': dynamic_reconfigure.client.Client('/current/attention', timeout=0.1),
-            'animation': dynamic_reconfigure.client.Client('/current/animations', timeout=0.1),
+        self.clients = clients or {
+            'attention': dynamic_reconfigure.client.Client(
+                '/current/attention', timeout=0.1,
+                config_callback=lambda config: self.target_config_callback('attention', config)),
+            'animation': dynamic_reconfigure.client.Client(
+                '/current/animations', timeout=0.1,
+                config_callback=lambda config: self.target_config_callback('animation', config)),
         }
         # robot properties
         self.props = {
@@ -168,6 +395,8 @@ class Robot(HierarchicalMachine):
             'disable_keepalive': None,
         }
 
+        # Average time (s) of a config push, used to estimate time saved by skipped pushes
+        self.push_latency = 0.0
         self._before_presentation = ''
         self._current_performance = None
         # State server mostly used for checking current states settings
@@ -176,25 +405,34 @@ class Robot(HierarchicalMachine):
         HierarchicalMachine.__init__(self, states=STATES, transitions=TRANSITIONS, initial='idle',
                                           ignore_invalid_triggers=True, after_state_change=self.state_changed,
                                           before_state_change=self.on_before_state_change)
+        # States settings servers are created when state is first entered, so only visited states can be edited
+        # until then. Preloading creates all of them in background, which keeps full ROS graph size
+        if rospy.get_param('~preload_state_configs', False):
+            t = threading.Thread(target=self.create_state_servers)
+            t.daemon = True
+            t.start()
         # Main param server
         self.server = Server(StatesConfig, self.config_callback, namespace='/behavior/behavior_settings')
         self.faces_db_file = None
-        self.known_faces = {}
-        self.faces_last_update = time.time()
+        self.known_faces = KnownFaces()
         # Faces last seen database:
         try:
             assemblies = rospy.get_param('/assemblies')
             assembly = assemblies[0] if self.robot_name in assemblies[0] else assemblies[1]
-            self.faces_db_file = os.path.join(assembly,'known_faces.yaml')
-            with open(self.faces_db_file, 'r') as stream:
-                try:
-                    self.known_faces = yaml.load(stream)
-                except yaml.YAMLError as exc:
-                    logger.warn(exc)
+            self.faces_db_file = os.path.join(assembly,'known_faces.db')
+            self.known_faces = KnownFaces(self.faces_db_file, os.path.join(assembly,'known_faces.yaml'))
         except Exception as e:
             logger.error("Cant load the known faces {}".format(e))
+        rospy.Timer(rospy.Duration(FACES_WRITE_TIME), self.known_faces.write)
+        # Performance keywords, rebuilt only if performances are changed
+        self.keyword_index = KeywordIndex()
+        self.keywords_checked = None
+        # Greeting performances by face name
+        self.greetings = {}
+        self.greetings_version = None
         rospy.Subscriber('/{}/perception/state'.format(self.robot_name), State, self.perception_state_cb)
 
+    @instrumented('states: perception_state_cb')
     def perception_state_cb(self, msg):
         # Ignore perception while no interacting
         if not self.state == 'interacting_interested':
@@ -204,50 +442,28 @@ class Robot(HierarchicalMachine):
                 if f.first_name is not "":
                     name = f.first_name
                     # repeating face, enroll but don't play any timeline
-                    if name not in self.known_faces.keys():
-                        self.known_faces[name] = {'last_seen': time.time()}
-                        self.sync_faces()
+                    if name not in self.known_faces:
+                        self.known_faces.seen(name, time.time())
                     else:
-                        last_seen = self.known_faces[name]['last_seen']
+                        last_seen = self.known_faces.last_seen(name)
                         rospy.set_param('/last_known_face', name)
                         current_time = time.time()
-                        self.known_faces[name]['last_seen'] = current_time
-                        # Update every 10s
-                        if self.faces_last_update + 10 < time.time():
-                            self.sync_faces()
-                        if current_time - last_seen > 60*60*24:
-                            performance_kwd = 'faceid_{}_{}'.format('long',name)
-                            performances = self.find_performance_by_speech(performance_kwd)
-                            if len(performances) > 0:
-                                self.services['performance_runner'](random.choice(performances))
-                                return
-                        if current_time - last_seen > 60 *15:
-                            performance_kwd = 'faceid_{}_{}'.format('short', name)
-                            performances = self.find_performance_by_speech(performance_kwd)
-                            if len(performances) > 0:
+                        # Written to database in background
+                        self.known_faces.seen(name, current_time)
+                        for (absence, _), performances in zip(GREETINGS, self.greeting_performances(name)):
+                            if current_time - last_seen > absence and len(performances) > 0:
                                 self.services['performance_runner'](random.choice(performances))
                                 return
-                        if current_time - last_seen > 60*60*24:
-                            performance_kwd = 'faceid_{}_unknown'.format('long',name)
-                            performances = self.find_performance_by_speech(performance_kwd)
-                            if len(performances) > 0:
-                                self.services['performance_runner'](random.choice(performances))
-                                return
-                        if current_time - last_seen > 60 *15:
-                            performance_kwd = 'faceid_{}_unknown'.format('short', name)
-                            performances = self.find_performance_by_speech(performance_kwd)
-                            if len(performances) > 0:
-                                self.services['performance_runner'](random.choice(performances))
-                                return
-
 
-    def sync_faces(self):
-        try:
-            self.faces_last_update = time.time()
-            with open(self.faces_db_file, 'w') as outfile:
-                yaml.dump(self.known_faces, outfile, default_flow_style=False)
-        except:
-            pass
+    def greeting_performances(self, name):
+        """ Performances for each of GREETINGS, cached per name until performances are changed"""
+        self.refresh_keywords()
+        if self.greetings_version != self.keyword_index.version:
+            self.greetings = {}
+            self.greetings_version = self.keyword_index.version
+        if name not in self.greetings:
+            self.greetings[name] = [self.keyword_index.match(kwd.format(name)) for _, kwd in GREETINGS]
+        return self.greetings[name]
 
     # Calls after each state change to apply new configs
     def state_changed(self):
@@ -256,13 +472,75 @@ class Robot(HierarchicalMachine):
         # State object
         state = self.get_state(self.state)
         logger.warn(self.state)
+        stats = []
         if state.attention_config:
-            self.clients['attention'].update_configuration(state.attention_config)
+            stats.append(self.push_config('attention', self.clients['attention'], state.attention_config))
         if state.animations_config:
-            self.clients['animation'].update_configuration(state.animations_config)
+            stats.append(self.push_config('animation', self.clients['animation'], state.animations_config))
         # Aply general behavior for states
         if state.state_config:
-            self.state_server.update_configuration(state.state_config)
+            stats.append(self.push_config('state_settings', self.state_server, state.state_config))
+        self.publish_push_stats(stats)
+
+    def push_config(self, name, target, config):
+        """ Sends only settings which differ from config last pushed to the target (client or server).
+        Returns (name, keys sent, bytes sent, bytes saved, latency, latency saved)"""
+        pushed = self.pushed.get(name, {})
+        # Client config is updated asynchronously, so it may lag behind the last push (key is then re-sent),
+        # but it also catches values changed by others since (e.g. from rqt_reconfigure)
+        current = target.config or {}
+        values = dict((k, v) for k, v in config.items() if k != 'groups')
+        changes = dict((k, v) for k, v in values.items() if pushed.get(k) != v or current.get(k, v) != v)
+        full_size = len(json.dumps(values))
+        if not changes:
+            return name, 0, 0, full_size, 0.0, self.push_latency
+        size = len(json.dumps(changes))
+        start = time.time()
+        self.update_target(name, target, changes)
+        latency = time.time() - start
+        self.push_latency = latency if self.push_latency == 0 else 0.8 * self.push_latency + 0.2 * latency
+        return name, len(changes), size, full_size - size, latency, 0.0
+
+    def update_target(self, name, target, changes):
+        """ Updates target config and remembers values it has accepted"""
+        result = target.update_configuration(changes)
+        pushed = self.pushed.setdefault(name, {})
+        pushed.update(changes)
+        if result:
+            pushed.update((k, v) for k, v in result.items() if k != 'groups')
+        return result
+
+    def target_config_callback(self, name, config):
+        """ Forgets values pushed to the target once it reports different ones, i.e. its config was changed
+        by someone else or the node was restarted (client then receives its initial config)"""
+        pushed = self.pushed.get(name)
+        if pushed and any(config.get(k, v) != v for k, v in pushed.items()):
+            self.pushed.pop(name, None)
+
+    def publish_push_stats(self, stats):
+        status = DiagnosticStatus()
+        status.name = 'states: config push'
+        status.hardware_id = 'behavior'
+        status.message = self.state
+        for name, keys, size, saved, latency, latency_saved in stats:
+            status.values += [
+                KeyValue('{} keys'.format(name), str(keys)),
+                KeyValue('{} bytes'.format(name), str(size)),
+                KeyValue('{} bytes saved'.format(name), str(saved)),
+                KeyValue('{} latency (ms)'.format(name), '{:.1f}'.format(1000.0 * latency)),
+                KeyValue('{} latency saved (ms)'.format(name), '{:.1f}'.format(1000.0 * latency_saved)),
+            ]
+        msg = DiagnosticArray()
+        msg.header.stamp = rospy.Time.now()
+        msg.status = [status]
+        self.topics['diagnostics'].publish(msg)
+
+    def create_state_servers(self):
+        for state in list(self.states.values()):
+            try:
+                state.create_servers()
+            except Exception as e:
+                logger.error("Can't create settings for state {}: {}".format(state.name, e))
 
     def state_callback(self, msg):
         state = msg.data
@@ -302,6 +580,7 @@ class Robot(HierarchicalMachine):
         return config
 
     # Handles all speech inputs
+    @instrumented('states: speech_cb')
     def speech_cb(self, msg):
         try:
             speech = str(msg.utterance).lower()
@@ -353,33 +632,38 @@ class Robot(HierarchicalMachine):
 
     def find_performance_by_speech(self, speech):
         """ Finds performances which one of keyword matches"""
-        performances = []
-        for performance, keywords in self.get_keywords().items():
-            if self.performance_keyword_match(keywords, speech):
-                performances.append(performance)
-        return performances
+        self.refresh_keywords()
+        return self.keyword_index.match(speech)
+
+    def refresh_keywords(self):
+        """ Rebuilds keyword index only if performances have changed. Param is read from rospy cache, which is
+        updated by master on change, so only first call goes to param server. Comparing whole performances tree
+        is not free either, so it is done at most once per KEYWORDS_CHECK_TIME"""
+        now = monotonic()
+        if self.keywords_checked is not None and now - self.keywords_checked < KEYWORDS_CHECK_TIME:
+            return
+        self.keywords_checked = now
+        try:
+            try:
+                performances = rospy.get_param_cached(os.path.join('/', self.robot_name, 'webui/performances'))
+            except KeyError:
+                performances = {}
+            if self.keyword_index.update(performances):
+                logger.info("Keyword index rebuilt")
+        except Exception as e:
+            logger.error("Can't refresh performance keywords {}".format(e))
 
     @staticmethod
-    def performance_keyword_match(keywords, input):
-        for keyword in keywords:
-            if not keyword:
-                continue
-            # Currently only simple matching
-            if re.search(r"\b{}\b".format(keyword), input, flags=re.IGNORECASE):
-                return True
-        return False
-
-    def get_keywords(self, performances=None, keywords=None, path='.'):
-        if performances is None:
-            performances = rospy.get_param(os.path.join('/', self.robot_name, 'webui/performances'))
+    def get_keywords(performances, keywords=None, path='.'):
+        if keywords is None:
             keywords = {}
 
         if 'properties' in performances and 'keywords' in performances['properties']:
             keywords[path] = performances['properties']['keywords']
 
         for key, value in performances.items():
-            if key != 'properties':
-                self.get_keywords(performances[key], keywords, os.path.join(path, key).strip('./'))
+            if key != 'properties' and isinstance(value, dict):
+                Robot.get_keywords(value, keywords, os.path.join(path, key).strip('./'))
 
         return keywords
 
@@ -423,24 +707,31 @@ class Robot(HierarchicalMachine):
 
     def on_enter_interacting_listening(self):
         # Listen only for some time
-        self._state_timer = threading.Timer(self.config.listening_time, self.finish_listening)
-        self._state_timer.start()
+        self.start_state_timer(self.config.listening_time, self.finish_listening)
 
     def on_enter_interacting_thinking(self):
         # If robot doesnt start speaking go back to listening
-        self._state_timer = threading.Timer(self.config.thinking_time, self.could_think_of_anything)
-        self._state_timer.start()
+        self.start_state_timer(self.config.thinking_time, self.could_think_of_anything)
+
+    def start_state_timer(self, timeout, trigger):
+        with self.state_timer_lock:
+            self._state_timer = self.timers.schedule(timeout, lambda handle: self.state_timeout(handle, trigger))
+
+    def state_timeout(self, handle, trigger):
+        # Timeout is stale if state has changed after it was due. Check and trigger are done under the lock
+        # taken by transition hooks, so state can't change in between
+        with self.state_timer_lock:
+            if handle != self._state_timer:
+                return
+            self._state_timer = None
+            trigger()
 
     def on_before_state_change(self):
         # Clean state timer
-        if self._state_timer:
-            try:
-                logger.warn("STOP")
-                self._state_timer.cancel()
-                self._state_timer = False
-            except Exception as e:
-                logger.warn(e)
-                pass
+        with self.state_timer_lock:
+            if self._state_timer:
+                self.timers.cancel(self._state_timer)
+                self._state_timer = None
     @property
     def disable_attention(self):
         return self.props['disable_attention']
@@ -450,7 +741,7 @@ class Robot(HierarchicalMachine):
         if self.props['disable_attention'] != val:
             self.props['disable_attention'] = val
             try:
-                self.clients['attention'].update_configuration({'enable_flag': not val})
+                self.update_target('attention', self.clients['attention'], {'enable_flag': not val})
             except Exception as e:
                 logger.errot(e)
 
@@ -464,7 +755,7 @@ class Robot(HierarchicalMachine):
             self.props['disable_animations'] = val
             try:
                 logger.warn("Aniamtions disabled: {}".format(val))
-                self.clients['animation'].update_configuration({'enable_flag': not val})
+                self.update_target('animation', self.clients['animation'], {'enable_flag': not val})
             except Exception as e:
                 logger.error(e)
     @property
@@ -523,5 +814,6 @@ class Robot(HierarchicalMachine):
 
 if __name__ == "__main__":
     rospy.init_node("hrx_graph")
+    instrumentation.start()
     robot = Robot()
     rospy.spin()
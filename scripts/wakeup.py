@@ -0,0 +1,31 @@
+# Interruptible sleep shared by animations scheduler and state timeouts
+import os
+import select
+import fcntl
+
+
+class Wakeup:
+    """ Interruptible sleep. Blocks in select on a pipe, so waiting does not poll"""
+
+    def __init__(self):
+        self._r, self._w = os.pipe()
+        for fd in (self._r, self._w):
+            fcntl.fcntl(fd, fcntl.F_SETFL, fcntl.fcntl(fd, fcntl.F_GETFL) | os.O_NONBLOCK)
+
+    def set(self):
+        try:
+            os.write(self._w, b'x')
+        except OSError:
+            # Pipe is full, wakeup is pending anyway
+            pass
+
+    def wait(self, timeout=None):
+        """ Waits until set or timeout (None waits forever). Returns True if woken up by set"""
+        ready, _, _ = select.select([self._r], [], [], timeout)
+        if ready:
+            try:
+                while os.read(self._r, 4096):
+                    pass
+            except OSError:
+                pass
+        return bool(ready)